@@ -1,15 +1,14 @@
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, wait
+import argparse
+import atexit
+import signal
+import re
 import threading
-from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.common.exceptions import TimeoutException
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.common.keys import Keys
 import time
-import pandas as pd
-from io import StringIO
 from datetime import datetime, date
 import openpyxl
 import csv
@@ -18,21 +17,75 @@ import requests
 from bs4 import BeautifulSoup
 import sys
 import os
+import tempfile
+import sqlite3
 from O365 import Account
 from O365.message import Message
 from azure.identity import ClientSecretCredential
 from azure.keyvault.secrets import SecretClient
 from dotenv import load_dotenv
-
-
-# Checking if the parameter for the number of parts is present or not.
-if len(sys.argv) != 3:
-    print("Usage: python script_name.py <input_csv_file> <thread_count>")
-    sys.exit(1)
-
-# Checking if the provided CSV file path exists
-csv_file_path = sys.argv[1]
-if not os.path.exists(csv_file_path):
+from marx_scheduler import LookupScheduler, priority_score
+from marx_tuning import WorkerPoolTuner
+from marx_recovery import EligibilityRecovery, RecoveryError
+from marx_cache import ResultCache, RECORD, NOT_ENROLLED, INVALID_MBI, NOT_FOUND
+from marx_browser import launch_browser
+from marx_rules import evaluate_plan_change, replay_plan_changes
+from marx_profiler import RunProfiler
+from marx_lookup import TabPool
+from marx_breaker import CircuitBreaker
+from marx_watchdog import BrowserWatchdog, BrowserKilled
+from marx_sampling import StratifiedSampler, load_contract_directory, contract_changed, UNKNOWN as UNKNOWN_CONTRACT
+from marx_leases import LeaseManager
+from marx_service import LookupService, start_server, submit_policies, FAILED, TIMED_OUT
+from TLD_Tiers_Updated import fetch_policies, filter_tier, write_tier_csv, policy_columns, tier_file_names
+
+
+# Create an argument parser
+parser = argparse.ArgumentParser(description="Retrieve MARx data for the policies in a Tiers CSV file and update TLD-CRM")
+parser.add_argument("input_csv_file", nargs="?", default=None, help="CSV file generated through the TLD_Tiers script i.e Tier1_Policies.csv. With --tier, where the tier's policies are written")
+parser.add_argument("thread_count", type=int, nargs="?", default=None, help="Maximum number of threads (CMS accounts) to launch. Defaults to every account found in the Key Vault, up to max_workers")
+parser.add_argument("--initial-workers", type=int, default=2, help="Number of threads to start with before scaling on observed latency and errors")
+parser.add_argument("--cache-ttl", type=float, default=12, help="Hours for which a MARx result looked up today is reused by later runs")
+parser.add_argument("--cache-size", type=int, default=50000, help="Maximum number of MARx results kept in the cache")
+parser.add_argument("--no-cache", action="store_true", help="Look up every Medicare Number in MARx, even if it was looked up earlier today")
+parser.add_argument("--lean-browser", action="store_true", help="Block images, fonts and analytics hosts and cap Chrome's cache and renderer memory")
+parser.add_argument("--browser-profile-dir", default=None, help="Directory of Chrome profiles reused between runs (one sub-directory per CMS account)")
+parser.add_argument("--replay", nargs="?", const="MARx_Update.csv", default=None, help="Evaluate the alert rules again on stored MARx results (default MARx_Update.csv) for the policies in the CSV file, without the portal")
+parser.add_argument("--push", action="store_true", help="With --replay, update the leads whose status changed in TLD-CRM")
+parser.add_argument("--profile", action="store_true", help="Profile every thread and write a merged report and a flamegraph-compatible collapsed stacks file")
+parser.add_argument("--tabs-per-account", type=int, default=1, help="Number of MARx Eligibility tabs each CMS account works on at the same time")
+parser.add_argument("--breaker-failures", type=int, default=5, help="Failed lookups in a row after which an account pauses its lookups and probes the portal")
+parser.add_argument("--global-breaker-failures", type=int, default=10, help="Failed lookups in a row across all accounts after which every account pauses its lookups")
+parser.add_argument("--breaker-probe-interval", type=float, default=120, help="Seconds between probe lookups while a circuit breaker is open")
+parser.add_argument("--lookup-deadline", type=float, default=300, help="Seconds after which a browser stuck on a lookup is killed and replaced")
+parser.add_argument("--sample", type=float, default=None, help="Look up a stratified random sample of this fraction of the policies (i.e 0.1) to estimate the drift rate, i.e for Tier 3")
+parser.add_argument("--sample-min", type=int, default=10, help="With --sample, minimum number of policies sampled per carrier, plan type and sale month")
+parser.add_argument("--drift-threshold", type=float, default=0.05, help="With --sample, change rate above which every policy of a stratum is looked up")
+parser.add_argument("--sample-seed", type=int, default=None, help="With --sample, seed of the random sample, to draw the same sample again")
+parser.add_argument("--wait-for-accounts", type=float, default=0, help="Minutes to wait for a CMS account to be released by another instance of the script if all of them are in use")
+parser.add_argument("--lease-file", default=os.path.join(tempfile.gettempdir(), "marx_leases.db"), help="File through which the instances of the script on this host share the CMS accounts")
+parser.add_argument("--tier", type=int, choices=[1, 2, 3], default=None, help="Fetch the policies of a tier from TLD-CRM while the CMS accounts log in, and look them up as soon as they are scored")
+parser.add_argument("--serve", type=int, nargs="?", const=8765, default=None, metavar="PORT", help="Keep MARx sessions logged in and answer lookups through a local HTTP/JSON API (default port 8765)")
+parser.add_argument("--service-url", default=None, help="Send the policies to a running service (i.e http://127.0.0.1:8765) instead of logging into the portal")
+parser.add_argument("--deadline", type=float, default=None, help="Time budget in minutes. Highest priority lookups run first, the rest are deferred")
+
+# Parse the command-line arguments
+args = parser.parse_args()
+
+# Checking if the provided CSV file path exists. In pipeline mode (--tier) the file is only written.
+csv_file_path = args.input_csv_file
+if args.serve is not None:
+    if args.service_url is not None or args.tier is not None or args.replay is not None or args.sample is not None or args.deadline is not None:
+        raise SystemExit("--serve only answers lookups through its API and can't be used with --service-url, --tier, --replay, --sample or --deadline. Terminating...")
+elif args.service_url is not None and (args.sample is not None or args.deadline is not None or args.replay is not None):
+    raise SystemExit("--service-url sends every policy to the service and can't be used with --sample, --deadline or --replay. Terminating...")
+elif args.tier is not None:
+    if args.replay is not None:
+        raise SystemExit("--replay reads an existing CSV file and can't be used with --tier. Terminating...")
+    csv_file_path = csv_file_path or tier_file_names[args.tier]
+elif csv_file_path is None:
+    raise SystemExit("Provide a CSV file or a tier with --tier. Terminating...")
+elif not os.path.exists(csv_file_path):
     raise SystemExit("Provided CSV File not found. Terminating...")
 
 #-----------------------
@@ -41,30 +94,78 @@ if not os.path.exists(csv_file_path):
 
 # Naming the error_log.txt file with today's date
 error_log_name = f"error_log_{datetime.now().strftime('%m_%d_%Y')}.txt"
-send_email = False
+failed_threads = 0
 policies_count = 0
 alerts_count = 0
 max_retries = 3
-csv_file_path = sys.argv[1]
+prefetch_threads = 5
+max_workers = 8
+cache_file_name = 'MARx_Cache.db'
+# Seconds a browser may take to log in or recover before the watchdog kills it, the number of
+# times the browser of an account is replaced, and the seconds between checks while paused
+session_deadline = 900
+max_browser_replacements = 3
+breaker_wait = 5
+# Seconds between checks on the sampled lookups, and without any of them finishing before the
+# sample is evaluated with the lookups done so far
+sample_wait = 10
+sample_stall_timeout = 1800
+# Seconds between attempts to lease a CMS account when they are all in use
+lease_poll = 30
+# Service: the API only listens on this host, as it has no authentication. Threads that stopped on an
+# error are restarted after 'service_restart_delay' seconds, doubled on every failure in a row up to
+# 'service_max_restart_delay', so that a failing login doesn't send a 2FA code every interval.
+service_host = "127.0.0.1"
+service_restart_delay = 60
+service_max_restart_delay = 3600
+# Priority of the requested lookups, seconds a request waits for its results (and after which an
+# unfinished lookup is given up), seconds for which a result is shared with identical requests,
+# seconds after which an idle session is refreshed so that it stays logged in, and policies sent
+# to the service per request
+service_priority = 1000
+service_timeout = 600
+coalesce_window = 30
+session_keepalive = 600
+service_batch_size = 25
+service_client_threads = 4
 
 # Extract the file name from the path
-csv_file_name = os.path.basename(csv_file_path)
-num_parts = int(sys.argv[2])
+csv_file_name = os.path.basename(csv_file_path) if csv_file_path else "MARx lookup service"
 current_date = datetime.now().strftime("%m/%d/%Y")
 
+# Lines added to the completion report and the previous MARx data fetched per lead_id
+run_report = []
+prior_marx_data = {}
+profiler = None
+sampler = None
+service = None
+contract_directory = {}
+
 # File and Counter locks
 policy_count_lock = threading.Lock()
 alerts_count_lock = threading.Lock()
 marx_file_lock = threading.Lock()
 error_file_lock = threading.Lock()
 excel_file_lock = threading.Lock()
+report_lock = threading.Lock()
 
-# Making an output file for the MARx data if it doesn't exist already
+# Making an output file for the MARx data if it doesn't exist already. The statuses before and after
+# the update are kept so that the alert rules can be replayed without the portal.
+header_row = ['marx_last_udpate', 'marx_contract', 'marx_pbp', 'marx_plan_code_desc', 'marx_start_date', 'marx_carrier_name', 'marx_plan_type', 'policy_id', 'lead_id', 'date_effective_in_tld', 'date_sold_in_tld', 'marx_plan_change_result', 'previous_plan_change_result', 'previous_marx_last_udpate']
 if not os.path.exists('MARx_Update.csv'):
     with open('MARx_Update.csv', 'w', newline='', encoding='utf-8') as data_file:
-        header_row = ['marx_last_udpate', 'marx_contract', 'marx_pbp', 'marx_plan_code_desc', 'marx_start_date', 'marx_carrier_name', 'marx_plan_type', 'policy_id', 'lead_id', 'date_effective_in_tld', 'date_sold_in_tld']
         writer= csv.writer(data_file)
         writer.writerow(header_row)
+else:
+    # Add the new columns to an output file written by an older version of the script
+    with open('MARx_Update.csv', 'r', newline='', encoding='utf-8') as data_file:
+        existing_rows = list(csv.reader(data_file))
+    if existing_rows and existing_rows[0] != header_row:
+        with open('MARx_Update.csv', 'w', newline='', encoding='utf-8') as data_file:
+            writer= csv.writer(data_file)
+            writer.writerow(header_row)
+            for existing_row in existing_rows[1:]:
+                writer.writerow(existing_row + [''] * (len(header_row) - len(existing_row)))
 
                
 #--------------------------------------------------------
@@ -92,15 +193,42 @@ def azure_authenticate(client_id, client_secret, tenant_id, vault_url):
     
     return secret_client
 
-def get_marx_pbp_and_contract(lead_id):
-    url = f"https://cm.tldcrm.com/api/egress/leads?columns=marx_contract,marx_pbp,marx_plan_change_result,marx_last_udpate&import=lead_custom_field&lead_id={lead_id}"
-    payload = {}
-    headers = {
+def discover_cms_accounts(secret_client):
+    # This method lists the secrets in the Key Vault and returns the numbers of the CMS accounts
+    # that have a portal ID, a portal password and a mailbox i.e cms-portal-id-1, cms-portal-password-1, cms-mailbox-1
+    secret_names = {secret.name for secret in secret_client.list_properties_of_secrets() if secret.enabled}
+
+    accounts = []
+    for secret_name in secret_names:
+        match = re.fullmatch(r"cms-portal-id-(\d+)", secret_name)
+        if match:
+            account = int(match.group(1))
+            if f"cms-portal-password-{account}" in secret_names and f"cms-mailbox-{account}" in secret_names:
+                accounts.append(account)
+
+    return sorted(accounts)
+
+def account_resources(secret_client, account):
+    # This method returns what is leased along with a CMS account: its portal user and the mailbox
+    # receiving its 2FA codes, so that no two instances (or accounts) wait on the same code
+    portal_id = secret_client.get_secret(f"cms-portal-id-{account}").value.strip().lower()
+    mailbox = secret_client.get_secret(f"cms-mailbox-{account}").value.strip().lower()
+    return [f"cms-portal-id:{portal_id}", f"mailbox:{mailbox}"]
+
+def tld_headers():
+    # This method returns the headers of a TLD-CRM API request, with the credentials from the Key Vault
+    return {
         'tld-api-id': secret_client.get_secret('tld-api-id').value,
         'tld-api-key': secret_client.get_secret('tld-api-key').value,
         'Cookie': secret_client.get_secret('cookie-value').value
     }
 
+def get_marx_pbp_and_contract(lead_id, headers=None):
+    # 'headers' can be passed by callers requesting many leads, so the Key Vault is not asked every time
+    url = f"https://cm.tldcrm.com/api/egress/leads?columns=marx_contract,marx_pbp,marx_plan_change_result,marx_last_udpate&import=lead_custom_field&lead_id={lead_id}"
+    payload = {}
+    headers = headers or tld_headers()
+
     marx_pbp = ""
     marx_contract = ""
     marx_last_udpate = ""
@@ -243,7 +371,13 @@ def send_notification(attachment_name):
         m = mailbox.new_message()
         m.to.add(secret_client.get_secret('agent-alert-email').value)
         m.subject = f"Script Completion Report - {current_date}"
-        m.body = f"The MARx script successfully completed the job for {current_date}.<br> CSV File Processed: {csv_file_name}. <br> Total Policies Processed: {policies_count} <br> Total errors that need to be resolved: {alerts_count}"
+        if failed_threads:
+            completion = f"The MARx script completed the job for {current_date}, but {failed_threads} threads stopped on an error (see below)."
+        else:
+            completion = f"The MARx script successfully completed the job for {current_date}."
+        m.body = f"{completion}<br> CSV File Processed: {csv_file_name}. <br> Total Policies Processed: {policies_count} <br> Total errors that need to be resolved: {alerts_count}"
+        if run_report:
+            m.body = m.body + " <br> " + " <br> ".join(run_report)
 
         # Check if the attachment file exists before adding it
         if os.path.exists(attachment_name):
@@ -252,59 +386,255 @@ def send_notification(attachment_name):
         # Send notification
         m.send()                
 
-def split_csv_file(csv_file_path, num_parts):
-    # This method reads the inputted CSV file and split it into the specified number of parts
+def cache_result(lead_medicare_claim_number, outcome, data=None):
+    # This method stores the outcome of a MARx lookup in the result cache (if enabled). The cache may be
+    # shared with other instances, a write that stays locked is skipped rather than stopping the thread.
+    if result_cache is not None:
+        try:
+            result_cache.put(lead_medicare_claim_number, outcome, data)
+        except sqlite3.OperationalError as e:
+            print(f"Could not cache the result of Medicare Number: {lead_medicare_claim_number}: {e}")
+
+def log_error(error_message):
+    # This method appends an error message to today's error log
+    with error_file_lock:
+        with open(error_log_name, 'a') as error_file:
+            error_file.write(error_message + '\n')
+
+def profiled(function):
+    # This method returns 'function' running under the profiler of the thread that calls it, if profiling
+    return profiler.wrap(function) if profiler is not None else function
+
+def add_to_report(message):
+    # This method prints a message and adds it to the completion report sent out by email
+    print(message)
+    with report_lock:
+        run_report.append(message)
+
+def read_csv_file(csv_file_path):
+    # This method reads the inputted CSV file and returns its header and rows
     with open(csv_file_path, 'r') as csv_file:
         reader = csv.reader(csv_file)
         header = next(reader)  # First row is the header
+        rows = [row for row in reader]
+
+    return rows, header
+
+def schedule_rows(scheduler, rows, header):
+    # This method fetches the previous MARx data of every lead from TLD-CRM, scores each row
+    # with it and pushes the rows into the scheduler. The fetched data is kept in 'prior_marx_data'
+    # for the drift checks only: a lookup may run hours later, so the data a TLD-CRM update is
+    # based on is fetched again right before it. Once the deadline has passed, the remaining rows
+    # are pushed without a score, they are only deferred.
+    headers = tld_headers()
+
+    def fetch_prior_data(row):
+        if scheduler.deadline_passed():
+            return row, None
+        lead_id = row[header.index('lead_id')]
+        prior_marx_data[lead_id] = get_marx_pbp_and_contract(lead_id, headers)
+        return row, prior_marx_data[lead_id]
+
+    with ThreadPoolExecutor(max_workers=prefetch_threads) as executor:
+        for row, prior_data in executor.map(profiled(fetch_prior_data), rows):
+            score = priority_score(prior_data[3], row[header.index('policy_number')]) if prior_data is not None else 0
+            scheduler.push(row, score)
+
+def fetch_tier_rows(selected_tier, tier_file_path):
+    # This method fetches the policies of a tier from TLD-CRM and returns them as rows in the order of
+    # 'policy_columns', the same as they would be read from the tier's CSV file. The CSV file is still
+    # written, as a record of the policies of the run.
+    records = fetch_policies(secret_client)
+    if records is None:
+        raise SystemExit("Could not fetch the policies from TLD-CRM. Terminating...")
+
+    tier_records = filter_tier(records, selected_tier)
+    if tier_records:
+        write_tier_csv(tier_file_path, tier_records)
+    add_to_report(f"Fetched {len(tier_records)} Tier {selected_tier} policies from TLD-CRM into {tier_file_path}")
+
+    # Values missing from a record are written as empty strings in the CSV file
+    return [['' if record.get(column) is None else str(record.get(column)) for column in policy_columns] for record in tier_records]
+
+def schedule_sample(scheduler, rows, header, futures):
+    # This method schedules a stratified sample of the rows and waits for the sampled lookups to finish.
+    # Meanwhile, and once they are done, the rest of every stratum whose change rate crosses the drift
+    # threshold is scheduled as well.
+    global sampler
+    sampler = StratifiedSampler(rows, header, load_contract_directory('contract_directory.xlsx'), args.sample, args.sample_min, args.drift_threshold, args.sample_seed)
+    sample_rows = sampler.sample_rows()
+    add_to_report(f"Drift check: sampling {len(sample_rows)} of {len(rows)} policies in {len(sampler.strata)} strata")
+    schedule_rows(scheduler, sample_rows, header)
+
+    def schedule_escalations():
+        for (carrier, plan_type, sale_month), stratum_rows in sampler.take_escalations():
+            add_to_report(f"Drift check: looking up all {len(stratum_rows)} other policies of {carrier} / {plan_type} / {sale_month}")
+            schedule_rows(scheduler, stratum_rows, header)
+
+    outstanding = sampler.outstanding()
+    last_progress = time.monotonic()
+    while outstanding > 0 and not scheduler.deadline_passed() and not all(future.done() for future in futures):
+        schedule_escalations()
+        time.sleep(sample_wait)
+        if sampler.outstanding() < outstanding:
+            outstanding = sampler.outstanding()
+            last_progress = time.monotonic()
+        elif time.monotonic() - last_progress > sample_stall_timeout:
+            add_to_report(f"Drift check: no sampled lookup finished in {sample_stall_timeout}s, evaluating the sample without the last {outstanding}")
+            break
 
-        # Get the total number of rows in the CSV file
-        total_rows = sum(1 for _ in reader)
-
-        # Calculate the number of rows per part
-        rows_per_part = total_rows // num_parts
-
-        # Seek back to the beginning of the file
-        csv_file.seek(0)
-
-        # Store all the parts in a list
-        csv_parts = []
-
-        # Process each part
-        for part_num in range(num_parts):
-            start_row = part_num * rows_per_part
-            end_row = (part_num + 1) * rows_per_part if part_num < num_parts - 1 else total_rows
-
-            # Seek to the start row
-            csv_file.seek(0)  # Move to the beginning of the file
-            next(reader)  # Skip the header
-
-            for _ in range(start_row):
-                next(reader)
-
-            # Read the rows for the current part
-            part = [next(reader) for _ in range(end_row - start_row)]
-
-            # Append the part to the list
-            csv_parts.append(part)
-
-    return csv_parts, header
-
-def process_csv_part(part_num, part, header):
-    # Function to process partitioned CSV file
+    sampler.finish()
+    schedule_escalations()
+
+def schedule_input_rows(rows, futures):
+    # This method fetches the rows of the tier (--tier), then schedules a sample of them (--sample) or
+    # all of them, and closes the scheduler once no more rows will be added
+    try:
+        if args.tier is not None:
+            rows = fetch_tier_rows(args.tier, csv_file_path)
+        if args.sample is not None:
+            schedule_sample(scheduler, rows, header, futures)
+        else:
+            schedule_rows(scheduler, rows, header)
+    finally:
+        # No more rows will be added, let the threads start on the highest priority rows
+        scheduler.close()
+
+def service_row(mbi):
+    # This method returns the row of a lookup requested through the service, without a lead
+    return ['' if column != 'lead_medicare_claim_number' else mbi for column in policy_columns]
+
+def service_result(pending, finished):
+    # This method returns the result of a service lookup as a dictionary, with the eligibility
+    # record and the carrier and plan type of its contract
+    if not finished:
+        return {"mbi": pending.mbi, "outcome": TIMED_OUT, "record": None, "error": "The lookup did not finish in time"}
+    record = None
+    if pending.outcome == RECORD:
+        marx_contract = str(pending.data[0]).strip()
+        # Typecast PBP to int (originally float)
+        try:
+            marx_pbp = str(int(pending.data[1])).strip()
+        except:
+            marx_pbp = str(pending.data[1]).strip()
+        carrier_name, plan_type = contract_directory.get(marx_contract, (UNKNOWN_CONTRACT, UNKNOWN_CONTRACT))
+        record = {
+            "marx_contract": marx_contract,
+            "marx_pbp": marx_pbp,
+            "marx_plan_code_desc": str(pending.data[2]).strip(),
+            "marx_start_date": str(pending.data[3]).strip(),
+            "marx_carrier_name": carrier_name,
+            "marx_plan_type": plan_type,
+        }
+    return {"mbi": pending.mbi, "outcome": pending.outcome, "record": record, "error": pending.error}
+
+def handle_service_lookup(payload):
+    # This method answers a lookup request of the service. The payload has a single Medicare Number
+    # ("mbi"), a list of them ("mbis") or a list of policies with the columns of the Tiers CSV files
+    # ("policies"). With "write_back", the results are also applied to the policies in TLD-CRM.
     global policies_count
-    global alerts_count
-    
-    #------------------------------------
-    # EXECUTING CHROME DRIVER, NAVIGATING
-    # AND LOGGING INTO THE CMS PORTAL
-    #------------------------------------
-    print(f"Executing thread: {part_num}")
-    chrome_options = Options()
-    chrome_options.add_argument("--headless")
-    print("Launching Webdriver Instance")
-    # Create a WebDriver instance
-    driver = webdriver.Chrome(options=chrome_options)
+    if not isinstance(payload, dict):
+        return 400, {"error": "The request body must be a JSON object"}
+    policies = payload.get("policies")
+    if policies is None:
+        mbis = payload.get("mbis") if "mbis" in payload else [payload.get("mbi")]
+        if not isinstance(mbis, list) or not all(isinstance(mbi, str) and mbi for mbi in mbis):
+            return 400, {"error": "\"mbi\" must be a Medicare Number and \"mbis\" a list of them"}
+        policies = [{"lead_medicare_claim_number": mbi} for mbi in mbis]
+    write_back = bool(payload.get("write_back"))
+    if not policies or not isinstance(policies, list) or not all(isinstance(policy, dict) for policy in policies):
+        return 400, {"error": "Provide \"mbi\", \"mbis\" or \"policies\""}
+    if write_back and not all(policy.get('lead_id') and policy.get('date_sold') for policy in policies):
+        return 400, {"error": "Every policy needs a lead_id and a date_sold to be written back to TLD-CRM"}
+
+    # Every Medicare Number is requested before waiting on any of them, so that they are looked up in parallel
+    try:
+        timeout = float(payload.get("timeout", service_timeout))
+    except (TypeError, ValueError):
+        return 400, {"error": "\"timeout\" must be a number of seconds"}
+    pending_lookups = [service.request(str(policy.get('lead_medicare_claim_number') or '')) for policy in policies]
+    wait_until = time.monotonic() + timeout
+
+    results = []
+    for policy, pending in zip(policies, pending_lookups):
+        result = service_result(pending, pending.wait(max(0, wait_until - time.monotonic())))
+        if write_back:
+            result.update({"policy_id": policy.get('policy_id'), "lead_id": policy.get('lead_id'), "alert": False})
+            if result["outcome"] not in [FAILED, TIMED_OUT]:
+                row = ['' if policy.get(column) is None else str(policy.get(column)) for column in policy_columns]
+                try:
+                    with policy_count_lock:
+                        policies_count += 1
+                    _, result["alert"] = process_marx_result(row, policy_columns, pending.outcome, pending.data, True)
+                except Exception as e:
+                    log_error(f"Error: Could not update TLD-CRM for Medicare Number: {pending.mbi} for Policy ID:{policy.get('policy_id')}: {type(e).__name__}")
+                    result["error"] = f"Could not update TLD-CRM: {type(e).__name__}"
+        results.append(result)
+
+    if "policies" in payload or "mbis" in payload:
+        return 200, {"results": results}
+    return 200, results[0]
+
+def service_status():
+    # This method describes the service for GET /status
+    status = service.stats()
+    status.update({"sessions": tuner.active_count(), "queued": scheduler.pending()})
+    return status
+
+def stop_serving(signum, frame):
+    # Stops the service on SIGTERM the same way as Ctrl+C
+    raise KeyboardInterrupt
+
+def submit_to_service(service_url, rows, header):
+    # This method sends the rows to a running service in batches, with the results written back to
+    # TLD-CRM by the service, and reports the outcomes
+    global policies_count, alerts_count
+    policies = [dict(zip(header, row)) for row in rows]
+    batches = [policies[start:start + service_batch_size] for start in range(0, len(policies), service_batch_size)]
+    outcomes = {}
+
+    def submit_batch(batch):
+        # A batch that fails is logged and its policies counted as failed, the other batches carry on
+        try:
+            return submit_policies(service_url, batch, True, service_timeout)
+        except Exception as e:
+            for policy in batch:
+                log_error(f"Error: Service request failed for Medicare Number: {policy.get('lead_medicare_claim_number')} for Policy ID:{policy.get('policy_id')}: {type(e).__name__}")
+            return [{"mbi": policy.get('lead_medicare_claim_number'), "policy_id": policy.get('policy_id'), "outcome": FAILED} for policy in batch]
+
+    with ThreadPoolExecutor(max_workers=service_client_threads) as executor:
+        for results in executor.map(submit_batch, batches):
+            for result in results:
+                outcomes[result["outcome"]] = outcomes.get(result["outcome"], 0) + 1
+                if result.get("alert"):
+                    alerts_count += 1
+                if result.get("error"):
+                    log_error(f"Error: Service lookup for Medicare Number: {result['mbi']} for Policy ID:{result.get('policy_id')}: {result['error']}")
+            policies_count += len(results)
+            print(f"Service: {policies_count} of {len(policies)} policies done")
+
+    add_to_report(f"Sent {len(policies)} policies to the MARx service at {service_url}: " + ", ".join(f"{count} {outcome}" for outcome, count in sorted(outcomes.items())))
+
+def write_deferred_rows(scheduler, header):
+    # This method writes the rows that were not looked up before the deadline into a CSV file
+    # which can be passed to the script again, and returns the file name
+    deferred_rows = scheduler.deferred()
+    if not deferred_rows:
+        return None
+
+    deferred_file_name = f"Deferred_{datetime.now().strftime('%m_%d_%Y_%H%M')}_{csv_file_name}"
+    with open(deferred_file_name, 'w', newline='', encoding='utf-8') as deferred_file:
+        writer = csv.writer(deferred_file)
+        writer.writerow(header)
+        writer.writerows(deferred_rows)
+
+    reason = "Deadline reached" if scheduler.deadline_passed() else "Threads stopped before the end"
+    add_to_report(f"{reason}. {len(deferred_rows)} policies were deferred to {deferred_file_name}")
+    return deferred_file_name
+
+def log_into_cms_portal(driver, part_num):
+    # This method logs into the CMS portal with the account 'part_num', including the 2FA code from Outlook.
+    # It is also used by the page-state recovery when the session has been logged out.
 
     # Navigate to the URL
     driver.get('https://portal.cms.gov/portal/')
@@ -357,310 +687,653 @@ def process_csv_part(part_num, part, header):
     verify_button.click()
     time.sleep(30)
 
-    print("Navigating to MARx webpage")
-    # Navigate to MARx webpage
-    driver.get('https://portal.cms.gov/myportal/wps/myportal/cmsportal/marxaws/verticalRedirect/application')
-    time.sleep(5)
-
-    # Wait for the iframe to be visible and switch to it
-    iframe = WebDriverWait(driver, 180).until(EC.presence_of_element_located((By.ID, "obj_marxaws_wab_application")))
-    driver.switch_to.frame(iframe)
-
-    # Wait for the Logon button to be clickable and click it
-    logon_button = WebDriverWait(driver, 10).until(EC.element_to_be_clickable((By.ID, "userRole")))
-    logon_button.click()
-    time.sleep(5)
-
-    # Wait for the Beneficiaries button to be clickable and click it
-    beneficiaries_button = WebDriverWait(driver, 10).until(EC.element_to_be_clickable((By.XPATH, "//a[text()='Beneficiaries ']")))
-    beneficiaries_button.click()
-    time.sleep(3)
-
-    # Wait for the Eligibility button to be clickable and click it
-    eligibility_button = WebDriverWait(driver, 10).until(EC.element_to_be_clickable((By.XPATH, "//a[text()='Eligibility ']")))
-    eligibility_button.click()
-    time.sleep(3)
-
-    print("Starting to input Medicare Numbers into MARx.")
+def replay_stored_results(marx_update_path, csv_file_path, push):
+    # This method evaluates the alert rules again on the stored MARx results of the policies in the CSV file
+    # and writes the leads whose status changes into a diff CSV file. With 'push', only those leads are updated in TLD-CRM.
+    with open(marx_update_path, 'r', newline='', encoding='utf-8') as data_file:
+        stored_results = list(csv.DictReader(data_file))
+    with open(csv_file_path, 'r') as csv_file:
+        policies = {policy['policy_id']: policy for policy in csv.DictReader(csv_file)}
+
+    started = time.monotonic()
+    changes, evaluated, skipped = replay_plan_changes(stored_results, policies)
+    print(f"Replayed the alert rules on {evaluated} leads in {time.monotonic() - started:.2f}s. {len(changes)} changed, {skipped} skipped (not in the CSV file or stored without statuses)")
+
+    if not changes:
+        return
+
+    diff_file_name = f"MARx_Replay_Diff_{datetime.now().strftime('%m_%d_%Y_%H%M')}.csv"
+    with open(diff_file_name, 'w', newline='', encoding='utf-8') as diff_file:
+        writer = csv.DictWriter(diff_file, fieldnames=changes[0].keys())
+        writer.writeheader()
+        writer.writerows(changes)
+    print(f"Status changes written to {diff_file_name}")
+
+    if push:
+        updated = 0
+        skipped_leads = []
+        for change in changes:
+            # A lead whose status or MARx data changed in TLD-CRM since the stored lookup (an agent, TLD_Reset
+            # or a later run) is skipped, so that the replayed status doesn't overwrite it
+            _, _, current_last_update, current_plan_result = get_marx_pbp_and_contract(change['lead_id'])
+            if current_plan_result != change['stored_plan_change_result'] or is_newer_update(current_last_update, change['marx_last_udpate']):
+                skipped_leads.append(change['lead_id'])
+                continue
+            marx_data = {key: change[key] for key in ['lead_id', 'marx_last_udpate', 'marx_contract', 'marx_pbp', 'marx_plan_code_desc', 'marx_start_date', 'marx_carrier_name', 'marx_plan_type']}
+            marx_data['marx_plan_change_result'] = change['replayed_plan_change_result']
+            update_marx_data_in_tld(marx_data)
+            updated += 1
+        print(f"Updated {updated} leads in TLD-CRM")
+        if skipped_leads:
+            print(f"Skipped {len(skipped_leads)} leads changed in TLD-CRM since their stored lookup: {', '.join(skipped_leads)}")
+
+def is_newer_update(current_last_update, stored_last_update):
+    # This method returns whether the 'marx_last_udpate' in TLD-CRM is later than the stored one (MM/DD/YYYY)
+    try:
+        return datetime.strptime(current_last_update, "%m/%d/%Y") > datetime.strptime(stored_last_update, "%m/%d/%Y")
+    except ValueError:
+        return False
+
+def next_lookup(part_num, scheduler, header, block=True):
+    # This method returns the next row that needs a MARx lookup as a dictionary, or None once there is
+    # none left or the deadline has passed (or none right now, without 'block', or none for a while when
+    # serving). Rows that can't be looked up are logged, and rows with a result from earlier today are
+    # processed straight from the cache.
+    global policies_count
 
-    # Multiple potential errors  in source's HTML
-    mbi_error = "<h2>Attention: The beneficiary ID is not a valid MBI number</h2>"
-    not_found_error = "<h2>Attention: Beneficiary not found</h2>"
-    
-    #----------------------------------------
-    # AT THE "ELIGIBILITY" PAGE AT THIS POINT
-    #----------------------------------------
+    while True:
+        # Get the next highest priority row
+        row = scheduler.pop(block, session_keepalive if args.serve is not None else None)
+        if row is None:
+            return None
 
- 
-    for row in part:
         with policy_count_lock:
             policies_count += 1
-            
+
         # Get data from Policies CSV
         lead_medicare_claim_number = row[header.index("lead_medicare_claim_number")]
-        policy_number = row[header.index("policy_number")]
         date_sold = row[header.index("date_sold")]
-        
+
         # Convert date_sold to a datetime object
         try:
-            date_sold_datetime = datetime.strptime(date_sold, "%Y-%m-%d %H:%M:%S").date()
+            if not is_service_row(row, header):
+                datetime.strptime(date_sold, "%Y-%m-%d %H:%M:%S")
         except ValueError:
+            log_error(f"Error: Invalid date_sold: {date_sold} for Policy ID:{row[header.index('policy_id')]}")
+            fail_lookup(row, header, "Invalid date_sold")
             continue
-        
+
         # Only proceed if the medicare_number is 11 digits.
-        if len(lead_medicare_claim_number) == 11:
+        if len(lead_medicare_claim_number) != 11:
+            # Log error into error file.
+            log_error(f"Error: Incorrect Medicare Number: {lead_medicare_claim_number} for Policy ID:{row[header.index('policy_id')]}")
+            fail_lookup(row, header, "Incorrect Medicare Number")
+            continue
+
+        # Show input progress
+        print(f"Working on Medicare Number: {lead_medicare_claim_number} | Thread# {part_num}")
+
+        # Check for a result from earlier today before touching the browser
+        cached_result = result_cache.get(lead_medicare_claim_number) if result_cache is not None else None
+        if cached_result is not None:
+            lookup_outcome, first_row_data = cached_result
+            finish_lookup(row, header, lookup_outcome, first_row_data, True)
+            continue
+
+        return {"row": row, "mbi": lead_medicare_claim_number, "retries": 0, "cause": None}
+
+def process_marx_result(row, header, lookup_outcome, first_row_data, from_cache):
+    # This method applies the outcome of a MARx lookup (or a cached one) to a policy: it logs invalid and
+    # unknown Medicare Numbers, updates TLD-CRM with the MARx data and saves it to MARx_Update.csv.
+    # Returns whether the MARx contract of the lead changed since its last update (None if unknown),
+    # and whether an 'Alert' was raised.
+    global alerts_count
+
+    lead_medicare_claim_number = row[header.index("lead_medicare_claim_number")]
+    policy_number = row[header.index("policy_number")]
+    date_sold_datetime = datetime.strptime(row[header.index("date_sold")], "%Y-%m-%d %H:%M:%S").date()
+
+    if lookup_outcome == INVALID_MBI:
+        log_error(f"Error: Invalid Medicare Number: {lead_medicare_claim_number} for Policy ID:{row[header.index('policy_id')]}")
+        return None, False
+    elif lookup_outcome == NOT_FOUND:
+        log_error(f"Error: Beneficiary not found for Medicare Number: {lead_medicare_claim_number} for Policy ID:{row[header.index('policy_id')]}")
+        return None, False
+
+    # Getting today's date
+    today = date.today()
+    # Format the date in MM/DD/YYYY format
+    american_date_format = today.strftime("%m/%d/%Y")
+    american_date = datetime.strptime(american_date_format, "%m/%d/%Y").date()
+    
+    # Checking if customer is enrolled in any plan
+    # If any anomalies are encountered, skip to next Medicare number
+    try:
+        if lookup_outcome == NOT_ENROLLED or "The beneficiary is not currently enrolled in any plan" in first_row_data[0].strip():
+            if not from_cache:
+                cache_result(lead_medicare_claim_number, NOT_ENROLLED)
+            # If customers is not enrolled in any plan, upload blank data to the TLD with today's 'marx_last_udpate' field.
+            blank_data = {
+                "lead_id" : row[header.index('lead_id')],
+                "marx_last_udpate" : american_date_format
+            }
+            update_blank_data_in_tld(blank_data)
+            old_pbp, old_contract, _, _ = prior_marx_data.get(row[header.index('lead_id')], ('', '', '', ''))
+            return contract_changed(old_contract, old_pbp, '', ''), False
+    except:
+        log_error(f"Error: Unexpected MARx results for Medicare Number: {lead_medicare_claim_number} for Policy ID:{row[header.index('policy_id')]}: {first_row_data}")
+        return None, False
+    if not from_cache:
+        cache_result(lead_medicare_claim_number, RECORD, first_row_data)
+
+    # Getting marx data:
+    marx_last_udpate = american_date_format
+    marx_contract = str(first_row_data[0]).strip()
+    
+    # Typecast PBP to int (originally float)
+    try:
+        marx_pbp = str(int(first_row_data[1])).strip()
+    except:
+        marx_pbp = str(first_row_data[1]).strip()
         
-            # Show input progress
-            print(f"Working on Medicare Number: {lead_medicare_claim_number} | Thread# {part_num}")                                 
-                
-            # Wait for 60 seconds for the table to load. If it doesn't, refresh and retry until 'max_retries' are exhausted.
-            retries = 0
-            while retries < max_retries:
-                try:
-                    # Find and interact with the input_box
-                    input_box = WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.ID, "claimNumber")))
-                    # Clear the input box
-                    input_box.clear()
-                    time.sleep(1)
-                    # Input next medicare number
-                    input_box.send_keys(lead_medicare_claim_number)
-                    time.sleep(1)
-                    # Send "Enter/Return" key as input
-                    input_box.send_keys(Keys.RETURN)
-                    time.sleep(5)
-                    
-                    # Checking if the entered MBI Number is valid or not          
-                    if mbi_error in driver.page_source:
-                        error_message = f"Error: Invalid Medicare Number: {lead_medicare_claim_number} for Policy ID:{row[header.index('policy_id')]}"
-                        with error_file_lock:
-                            with open(error_log_name, 'a') as error_file:
-                                error_file.write(error_message + '\n')
-                        break
-                    elif not_found_error in driver.page_source:
-                        error_message = f"Error: Beneficiary not found for Medicare Number: {lead_medicare_claim_number} for Policy ID:{row[header.index('policy_id')]}"
-                        with error_file_lock:
-                            with open(error_log_name, 'a') as error_file:
-                                error_file.write(error_message + '\n')
-                        break
-                        
-                    # Wait for the results table to load
-                    table = WebDriverWait(driver, 60).until(EC.presence_of_element_located((By.CSS_SELECTOR, "table.eligTable7")))
-                    break
-                except:
-                    print("Exception occurred")
-                    # Functionality if an exception occurs
-                    retries += 1
-                    
-                    # Refresh the page in case a timeout exception occurs and retry
-                    driver.get('https://portal.cms.gov/myportal/wps/myportal/cmsportal/marxaws/verticalRedirect/application')
-                    time.sleep(10)
-
-                    # Wait for the iframe to be visible and switch to it
-                    iframe = WebDriverWait(driver, 60).until(EC.presence_of_element_located((By.ID, "obj_marxaws_wab_application")))
-                    driver.switch_to.frame(iframe)
-
-                    # Wait for the Logon button to be clickable and click it
-                    logon_button = WebDriverWait(driver, 20).until(EC.element_to_be_clickable((By.ID, "userRole")))
-                    logon_button.click()
-                    time.sleep(6)
-
-                    # Wait for the Beneficiaries button to be clickable and click it
-                    beneficiaries_button = WebDriverWait(driver, 20).until(EC.element_to_be_clickable((By.XPATH, "//a[text()='Beneficiaries ']")))
-                    beneficiaries_button.click()
-                    time.sleep(6)
-
-                    # Wait for the Eligibility button to be clickable and click it
-                    eligibility_button = WebDriverWait(driver, 20).until(EC.element_to_be_clickable((By.XPATH, "//a[text()='Eligibility ']")))
-                    eligibility_button.click()
-                    time.sleep(6) 
-                    
-            if (retries == max_retries) or (mbi_error in driver.page_source) or (not_found_error in driver.page_source):
-                continue
-                
-                
-            # Extract the table HTML
-            table_html = table.get_attribute("outerHTML")
+    marx_plan_code_desc = str(first_row_data[2]).strip()
+    marx_start_date = str(first_row_data[3]).strip()
+    marx_carrier_name = ''
+    marx_plan_type = ''
+    policy_id = row[header.index('policy_id')]
+    lead_id = row[header.index('lead_id')]
+    date_effective_in_tld = row[header.index('date_effective')]
+    date_sold_in_tld = row[header.index('date_sold')]
+    
+    # Retrieving old data from API before update, as it may have changed since the rows were scored
+    old_pbp, old_contract, old_last_update, old_plan_result = get_marx_pbp_and_contract(lead_id)
+    
+    # Calculate the date delta
+    date_delta = american_date - date_sold_datetime
+    #---------------------------
+    # ALERT STATUS FUNCTIONALITY
+    #---------------------------
+    marx_plan_change_result, alert_raised = evaluate_plan_change(policy_number, marx_contract, old_plan_result, old_last_update, date_delta.days)
+    if alert_raised:
+        with alerts_count_lock:
+            alerts_count+=1
+        
+    #-----------------------------------------
+    #  Load the Excel file to get
+    # 'marx_carrier_name' and 'marx_plan_type'
+    #-----------------------------------------
+    with excel_file_lock:
+        workbook = openpyxl.load_workbook('contract_directory.xlsx')
+
+        # Assuming we are working with the first worksheet in the Excel file
+        worksheet = workbook.active
+
+        # Iterate through the rows to find a match in the first column
+        for row in worksheet.iter_rows(values_only=True):
+            if row[0] == marx_contract:
+                # Assuming the match is found in the first column (column A)
+                # Get the values from the second and third columns (columns B and C)
+                marx_carrier_name = row[1]
+                marx_plan_type = row[2]  
+                break  # Exit the loop after the first match
+
+        # Close the Excel file
+        workbook.close()
+
+    # Creating dictionary for marx_data to be passed as an argument to POST/PUT function.
+    marx_data = {
+        "lead_id" : lead_id,
+        "marx_last_udpate" : marx_last_udpate,
+        "marx_contract" : marx_contract,
+        "marx_pbp" : marx_pbp,
+        "marx_plan_code_desc" : marx_plan_code_desc,
+        "marx_start_date" : marx_start_date,
+        "marx_carrier_name" : marx_carrier_name,
+        "marx_plan_type" : marx_plan_type,
+        "marx_plan_change_result" : marx_plan_change_result
+    }
+    
+    #------------------------------------------
+    # API CALL TO UPDATE TLD-CRM WITH MARX DATA
+    #------------------------------------------
+    update_marx_data_in_tld(marx_data)
+
+    # Save data to CSV
+    with marx_file_lock:
+        with open('MARx_Update.csv', 'a', newline='', encoding='utf-8') as data_file:
+            writer= csv.writer(data_file)
+            writer.writerow([marx_last_udpate, marx_contract, marx_pbp, marx_plan_code_desc, marx_start_date, marx_carrier_name, marx_plan_type, policy_id, lead_id, date_effective_in_tld, date_sold_in_tld, str(marx_plan_change_result), old_plan_result, old_last_update])
+
+    return contract_changed(old_contract, old_pbp, marx_contract, marx_pbp), alert_raised
+
+def record_sample(row, changed):
+    # This method records the result of a lookup with the drift sampler (if sampling)
+    if sampler is not None:
+        sampler.record(row, changed)
+
+def is_service_row(row, header):
+    # Rows without a lead are lookups requested through the service, with nothing to update in TLD-CRM
+    return service is not None and not row[header.index('lead_id')]
+
+def finish_lookup(row, header, lookup_outcome, first_row_data, from_cache):
+    # This method hands the outcome of a lookup to the service if it requested it, or applies it to the policy
+    if is_service_row(row, header):
+        if not from_cache and lookup_outcome in [RECORD, NOT_ENROLLED]:
+            cache_result(row[header.index('lead_medicare_claim_number')], lookup_outcome, first_row_data if lookup_outcome == RECORD else None)
+        service.resolve(row[header.index('lead_medicare_claim_number')], lookup_outcome, first_row_data)
+        return
+    changed, _ = process_marx_result(row, header, lookup_outcome, first_row_data, from_cache)
+    record_sample(row, changed)
+
+def fail_lookup(row, header, cause):
+    # This method records a row that could not be looked up
+    if is_service_row(row, header):
+        service.fail(row[header.index('lead_medicare_claim_number')], cause)
+    record_sample(row, None)
+
+def lookups_allowed(part_num):
+    # This method returns whether the circuit breakers of the account and of all accounts let a lookup through
+    # The account breaker is only used by this thread, so checking it first without starting a probe means
+    # its probe is only started once the global breaker let the lookup through as well
+    account_breaker = account_breakers[part_num]
+    return account_breaker.would_allow() and global_breaker.allow() and account_breaker.allow()
+
+def record_breaker_result(part_num, failed):
+    # This method records the result of a lookup with the circuit breakers of the account and of all accounts
+    for breaker in [account_breakers[part_num], global_breaker]:
+        if failed:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+
+def handle_failed_lookup(part_num, tab_pool, tab, error, retry_lookups, consecutive_failures, header):
+    # This method records a failed lookup, brings its tab back to the Eligibility form and queues the
+    # lookup to be submitted again, or logs it as dropped once 'max_retries' are exhausted.
+    # If the portal appears to reject parallel use, the session falls back to a single tab.
+    # If the watchdog killed a hung browser, the lookups of every tab are handed to the next browser of the account.
+    print(f"Exception occurred: {type(error).__name__}")
+    tuner.record(time.monotonic() - tab.started_at, True)
+    record_breaker_result(part_num, True)
+    lookup = tab_pool.release(tab)
+    lookup["retries"] += 1
+    lookup["cause"] = type(error).__name__
+    row = lookup["row"]
+
+    # Take the shortest path back to the Eligibility form from the page the browser is on
+    recovery_path = []
+    try:
+        if not watchdog.was_killed(part_num):
+            watchdog.begin(part_num, tab_pool.driver, session_deadline)
+            recovery_path = tab_pool.recover(tab)
+            lookup["cause"] = f"{lookup['cause']} on {recovery_path[0]} page"
+    except Exception as recovery_error:
+        if not watchdog.was_killed(part_num):
+            if isinstance(recovery_error, RecoveryError):
+                log_error(f"Error: Lookup dropped for Medicare Number: {lookup['mbi']} for Policy ID:{row[header.index('policy_id')]}. Cause: {recovery_error}")
+                fail_lookup(row, header, str(recovery_error))
+            else:
+                # Recovery stopped on something else (i.e. logging in again), the lookup itself can still be retried
+                retry_lookups.append(lookup)
+            # The thread stops, the lookups of the other tabs are handed back with the ones waiting for a retry
+            retry_lookups.extend(tab_pool.release(other_tab) for other_tab in tab_pool.tabs if other_tab.lookup is not None)
+            raise
+    finally:
+        watchdog.end(part_num)
+
+    if watchdog.was_killed(part_num):
+        lookup["cause"] = f"browser hung for more than {watchdog.lookup_deadline:.0f}s"
+
+    if lookup["retries"] >= max_retries:
+        log_error(f"Error: Lookup dropped after {max_retries} attempts for Medicare Number: {lookup['mbi']} for Policy ID:{row[header.index('policy_id')]}. Cause: {lookup['cause']}")
+        fail_lookup(row, header, f"Dropped after {max_retries} attempts: {lookup['cause']}")
+    else:
+        retry_lookups.append(lookup)
+
+    if watchdog.was_killed(part_num):
+        retry_lookups.extend(tab_pool.release(other_tab) for other_tab in tab_pool.tabs if other_tab.lookup is not None)
+        raise BrowserKilled(f"{lookup['cause']} on Medicare Number: {lookup['mbi']}")
+
+    if tab_pool.should_fall_back(recovery_path, consecutive_failures, error):
+        retry_lookups.extend(tab_pool.fall_back_to_one_tab())
+        add_to_report(f"Thread# {part_num} fell back to a single MARx tab after {consecutive_failures} failed lookups in a row ({lookup['cause']})")
+
+def process_csv_part(part_num, scheduler, header, retry_lookups):
+    # Function to process the rows handed out by the scheduler. 'retry_lookups' are the lookups
+    # to submit again after a failure, carried over from the previous browser of the account.
 
-            # Load the HTML table into a Pandas DataFrame
-            html_io = StringIO(table_html)
+    #------------------------------------
+    # EXECUTING CHROME DRIVER, NAVIGATING
+    # AND LOGGING INTO THE CMS PORTAL
+    #------------------------------------
+    print(f"Executing thread: {part_num}")
+    print("Launching Webdriver Instance")
+    # Create a WebDriver instance, with its own profile directory if profiles are reused
+    profile_dir = os.path.join(args.browser_profile_dir, f"account-{part_num}") if args.browser_profile_dir else None
+    driver = launch_browser(args.lean_browser, profile_dir)
+
+    tab_pool = None
+    try:
+        # Log in and get to the Eligibility page through the page-state recovery
+        watchdog.begin(part_num, driver, session_deadline)
+        recovery = EligibilityRecovery(driver, lambda driver: log_into_cms_portal(driver, part_num))
+        log_into_cms_portal(driver, part_num)
+        print("Navigating to MARx webpage")
+        recovery.recover()
+
+        # Open the additional Eligibility tabs within the same session
+        tab_pool = TabPool(driver, recovery)
+        if args.tabs_per_account > 1:
+            opened = tab_pool.open_tabs(args.tabs_per_account - 1)
+            print(f"Thread# {part_num} is working on {opened + 1} MARx tabs")
+        watchdog.end(part_num)
+
+        print("Starting to input Medicare Numbers into MARx.")
+
+        #----------------------------------------
+        # AT THE "ELIGIBILITY" PAGE AT THIS POINT
+        #----------------------------------------
+
+        # Number of failed lookups in a row
+        consecutive_failures = 0
+        out_of_rows = False
+
+        while True:
+            # Submit a Medicare Number in every idle tab
+            paused = False
+            idle = False
+            for tab in tab_pool.idle_tabs():
+                # Tabs closed by a fall back to a single tab are skipped
+                if tab not in tab_pool.tabs:
+                    break
+                if out_of_rows and not retry_lookups:
+                    break
+                # Nothing is submitted while a circuit breaker is open. Once half-open, a single lookup probes the portal.
+                if not lookups_allowed(part_num):
+                    paused = True
+                    break
+                if retry_lookups:
+                    lookup = retry_lookups.pop(0)
+                elif tuner.should_retire(part_num):
+                    # Stop taking rows once the tuner has removed this account from the pool
+                    print(f"Retiring thread: {part_num}")
+                    out_of_rows = True
+                    break
+                else:
+                    # Stop taking rows once there is none left or the deadline has passed. While other tabs
+                    # are busy, their results are read instead of waiting for more rows.
+                    block = tab_pool.oldest_busy_tab() is None
+                    lookup = next_lookup(part_num, scheduler, header, block)
+                    if lookup is None:
+                        out_of_rows = scheduler.exhausted()
+                        idle = block and not out_of_rows
+                        break
 
-            # Load the HTML table into a Pandas DataFrame
-            df = pd.read_html(html_io)[0]
+                try:
+                    watchdog.begin(part_num, driver)
+                    tab_pool.submit(tab, lookup)
+                    watchdog.end(part_num)
+                except Exception as e:
+                    consecutive_failures += 1
+                    handle_failed_lookup(part_num, tab_pool, tab, e, retry_lookups, consecutive_failures, header)
+
+            # Read the results of the tab that has waited the longest
+            tab = tab_pool.oldest_busy_tab()
+            if tab is None:
+                if paused and not scheduler.deadline_passed():
+                    time.sleep(breaker_wait)
+                    continue
+                if retry_lookups and not scheduler.deadline_passed():
+                    continue
+                if idle:
+                    # No lookup requested from the service for a while, keep the session logged in
+                    watchdog.begin(part_num, driver, session_deadline)
+                    tab_pool.refresh()
+                    watchdog.end(part_num)
+                    continue
+                # Lookups still waiting for a retry at the deadline are deferred with the other rows
+                for lookup in retry_lookups:
+                    scheduler.push(lookup["row"], 0)
+                retry_lookups.clear()
+                break
 
-            # Close the StringIO object
-            html_io.close()
+            # Keep track of the memory used by this browser session
+            driver.sample_rss()
 
-            # Extract the data from the first row of the DataFrame
-            first_row_data = df.iloc[0].tolist()
-            
-            # Getting today's date
-            today = date.today()
-            # Format the date in MM/DD/YYYY format
-            american_date_format = today.strftime("%m/%d/%Y")
-            american_date = datetime.strptime(american_date_format, "%m/%d/%Y").date()
-            
-            # Checking if customer is enrolled in any plan
-            # If any anomalies are encountered, skip to next Medicare number
+            # Wait for the results page to load and classify it in a single round trip: invalid MBI,
+            # beneficiary not found, not enrolled or the first row of the results table.
+            # If it doesn't load, recover and retry until 'max_retries' are exhausted.
             try:
-                if "The beneficiary is not currently enrolled in any plan" in first_row_data[0].strip():
-                    # If customers is not enrolled in any plan, upload blank data to the TLD with today's 'marx_last_udpate' field.
-                    blank_data = {
-                        "lead_id" : row[header.index('lead_id')],
-                        "marx_last_udpate" : american_date_format
-                    }
-                    update_blank_data_in_tld(blank_data)
-                    continue
-            except:
+                watchdog.begin(part_num, driver)
+                lookup_outcome, first_row_data = tab_pool.collect(tab)
+                watchdog.end(part_num)
+            except Exception as e:
+                consecutive_failures += 1
+                handle_failed_lookup(part_num, tab_pool, tab, e, retry_lookups, consecutive_failures, header)
                 continue
-            # Getting marx data:
-            marx_last_udpate = american_date_format
-            marx_contract = str(first_row_data[0]).strip()
-            
-            # Typecast PBP to int (originally float)
-            try:
-                marx_pbp = str(int(first_row_data[1])).strip()
-            except:
-                marx_pbp = str(first_row_data[1]).strip()
-                
-            marx_plan_code_desc = str(first_row_data[2]).strip()
-            marx_start_date = str(first_row_data[3]).strip()
-            marx_carrier_name = ''
-            marx_plan_type = ''
-            policy_id = row[header.index('policy_id')]
-            lead_id = row[header.index('lead_id')]
-            date_effective_in_tld = row[header.index('date_effective')]
-            date_sold_in_tld = row[header.index('date_sold')]
-            
-            # Calling API to get the current values of marx_pbp, marx_contract and comparing them with new ones
-            marx_plan_change_result = None
-            
-            # Retrieving old data from API before update
-            old_pbp, old_contract, old_last_update, old_plan_result = get_marx_pbp_and_contract(lead_id)
-            
-            # Calculate the date delta
-            date_delta = american_date - date_sold_datetime
-            #---------------------------
-            # ALERT STATUS FUNCTIONALITY
-            #---------------------------
-            # If Policy Number is blank, Nothing to compare!
-            if policy_number is None or policy_number == '':
-                marx_plan_change_result = None
-            
-            # Proceed if Policy Number is NOT blank
-            else:
-                # If marx_contract exists in policy_number, we have a 'Match'.
-                if marx_contract in policy_number:
-                    marx_plan_change_result = 'match'
-                
-                # If we previously had a 'match' and the updated contract doesn't 'match', trigger an 'Alert'.
-                elif old_plan_result == 'match' and marx_contract not in policy_number:
-                    with alerts_count_lock:
-                        alerts_count+=1
-                    marx_plan_change_result = 'Alert'
-                
-                # If a policy is on Resolved, Retained or Alert, keep as it is!
-                elif old_plan_result in ['Resolved', 'Retained', 'Alert']:
-                    marx_plan_change_result = old_plan_result
-                
-                # If it's been 3 or more days since the sale date and the policies still don't match, trigger an 'Alert'
-                elif old_plan_result is None and marx_plan_change_result is None and old_last_update is not None and date_delta.days >= 14:
-                    with alerts_count_lock:
-                        alerts_count+=1
-                    marx_plan_change_result = 'Alert'
-                
-                # No conditionals match, revert policy to None
-                else:
-                    marx_plan_change_result = None
-                
-            #-----------------------------------------
-            #  Load the Excel file to get
-            # 'marx_carrier_name' and 'marx_plan_type'
-            #-----------------------------------------
-            with excel_file_lock:
-                workbook = openpyxl.load_workbook('contract_directory.xlsx')
-
-                # Assuming we are working with the first worksheet in the Excel file
-                worksheet = workbook.active
-
-                # Iterate through the rows to find a match in the first column
-                for row in worksheet.iter_rows(values_only=True):
-                    if row[0] == marx_contract:
-                        # Assuming the match is found in the first column (column A)
-                        # Get the values from the second and third columns (columns B and C)
-                        marx_carrier_name = row[1]
-                        marx_plan_type = row[2]  
-                        break  # Exit the loop after the first match
-
-                # Close the Excel file
-                workbook.close()
-
-            # Creating dictionary for marx_data to be passed as an argument to POST/PUT function.
-            marx_data = {
-                "lead_id" : lead_id,
-                "marx_last_udpate" : marx_last_udpate,
-                "marx_contract" : marx_contract,
-                "marx_pbp" : marx_pbp,
-                "marx_plan_code_desc" : marx_plan_code_desc,
-                "marx_start_date" : marx_start_date,
-                "marx_carrier_name" : marx_carrier_name,
-                "marx_plan_type" : marx_plan_type,
-                "marx_plan_change_result" : marx_plan_change_result
-            }
-            
-            #------------------------------------------
-            # API CALL TO UPDATE TLD-CRM WITH MARX DATA
-            #------------------------------------------
-            update_marx_data_in_tld(marx_data)
 
-            # Save data to CSV
-            with marx_file_lock:
-                with open('MARx_Update.csv', 'a', newline='', encoding='utf-8') as data_file:
-                    writer= csv.writer(data_file)
-                    writer.writerow([marx_last_udpate, marx_contract, marx_pbp, marx_plan_code_desc, marx_start_date, marx_carrier_name, marx_plan_type, policy_id, lead_id, date_effective_in_tld, date_sold_in_tld])
-         
-        else:
-            # Log error into error file.
-            error_message = f"Error: Incorrect Medicare Number: {lead_medicare_claim_number} for Policy ID:{row[header.index('policy_id')]}"
-            with error_file_lock:
-                with open(error_log_name, 'a') as error_file:
-                    error_file.write(error_message + '\n')
-    
-    # Close the driver when execution is successful
-    driver.quit()
+            consecutive_failures = 0
+            tuner.record(time.monotonic() - tab.started_at, False)
+            record_breaker_result(part_num, False)
+            lookup = tab_pool.release(tab)
+            if lookup_outcome in [INVALID_MBI, NOT_FOUND]:
+                cache_result(lookup["mbi"], lookup_outcome)
+            try:
+                finish_lookup(lookup["row"], header, lookup_outcome, first_row_data, False)
+            except Exception as e:
+                # The MARx result is cached, only its update in TLD-CRM failed (i.e. a TLD-CRM request error)
+                log_error(f"Error: Lookup dropped for Medicare Number: {lookup['mbi']} for Policy ID:{lookup['row'][header.index('policy_id')]}. Cause: {type(e).__name__} while updating TLD-CRM")
+                fail_lookup(lookup["row"], header, f"{type(e).__name__} while updating TLD-CRM")
+
+        # Report the memory and page load times of the session
+        add_to_report(f"Browser for account {part_num}: {driver.summary()}")
+    finally:
+        # Lookups still in the tabs when the session stops on an error are handed over with the
+        # ones waiting for a retry, and the browser is closed in any case
+        if tab_pool is not None:
+            retry_lookups.extend(tab_pool.release(tab) for tab in tab_pool.tabs if tab.lookup is not None)
+        try:
+            driver.quit()
+        except Exception:
+            # The browser was killed by the watchdog or already gone
+            pass
 
 def thread_function(part_num):  
-    # Function to be executed by each thread
-    process_csv_part(part_num, csv_parts[part_num - 1], header)
+    # Function to be executed by each thread. If the watchdog kills a hung browser, the account
+    # carries on with a new one, up to 'max_browser_replacements' times.
+    retry_lookups = []
+    replacements = 0
+    try:
+        while True:
+            try:
+                process_csv_part(part_num, scheduler, header, retry_lookups)
+                break
+            except Exception as e:
+                if not watchdog.was_killed(part_num) or replacements >= max_browser_replacements:
+                    hand_back_lookups(part_num, retry_lookups, e)
+                    raise
+                replacements += 1
+                watchdog.replaced(part_num)
+                add_to_report(f"Replacing the browser of account {part_num} ({replacements} of {max_browser_replacements}): {e if isinstance(e, BrowserKilled) else type(e).__name__}")
+    finally:
+        watchdog.end(part_num)
+        tuner.release_account(part_num)
+
+def hand_back_lookups(part_num, retry_lookups, error):
+    # This method hands the lookups of a thread that stopped on an error back to the scheduler, so
+    # that the other threads take them or they are deferred with the rows that were not reached
+    for lookup in retry_lookups:
+        scheduler.push(lookup["row"], 0)
+    add_to_report(f"Thread# {part_num} stopped on {type(error).__name__}: {error}. {len(retry_lookups)} lookups handed back to the other threads")
+    retry_lookups.clear()
+
+def tune_worker_pool(executor, futures):
+    # This method adds or removes threads every 'tuner.interval' seconds until all of them have completed.
+    # When serving, it runs until the service is stopped and keeps at least one session logged in.
+    restart_failures = 0
+    while True:
+        wait(futures, timeout=tuner.interval)
+        if all(future.done() for future in futures):
+            if args.serve is None:
+                break
+            if futures[-1].exception() is not None:
+                restart_failures += 1
+                restart_delay = min(service_restart_delay * 2 ** (restart_failures - 1), service_max_restart_delay)
+                print(f"Restarting a session in {restart_delay}s after {restart_failures} failures in a row")
+                time.sleep(restart_delay)
+            else:
+                restart_failures = 0
+            if start_thread(executor, futures) is None:
+                time.sleep(lease_poll)
+            continue
+
+        decision, reason = tuner.evaluate()
+        print(f"Tuner: {reason}")
+        if decision > 0 and scheduler.pending() > tuner.active_count():
+            account = start_thread(executor, futures)
+            if account is not None:
+                add_to_report(f"Tuner added a thread for account {account}: {reason}")
+        elif decision < 0:
+            add_to_report(f"Tuner: {reason}")
+
+def start_thread(executor, futures):
+    # This method claims a free CMS account from the tuner and starts a thread for it
+    account = tuner.claim_account()
+    if account is not None:
+        futures.append(executor.submit(profiled(thread_function), account))
+    return account
 
 # Usage of ThreadPoolExecutor
 if __name__ == "__main__":
 
+    # Profile the main thread and every worker thread until the script exits
+    if args.profile:
+        profiler = RunProfiler()
+        profiler.start()
+        profile_name = f"MARx_Profile_{datetime.now().strftime('%m_%d_%Y_%H%M')}"
+        atexit.register(profiler.stop, f"{profile_name}.txt", f"{profile_name}.collapsed")
+
     # Authenticate with Azure Keyvault and retrieve a secret_client after proper handshake        
     secret_client = azure_authenticate(client_id, client_secret, tenant_id, vault_url)
+
+    # Replay mode only evaluates the alert rules on stored results, the portal is not used
+    if args.replay is not None:
+        replay_stored_results(args.replay, csv_file_path, args.push)
+        sys.exit(0)
+
+    # Send the policies to a running service instead of logging into the portal
+    if args.service_url is not None:
+        if args.tier is not None:
+            service_rows, service_header = fetch_tier_rows(args.tier, csv_file_path), policy_columns
+        else:
+            service_rows, service_header = read_csv_file(csv_file_path)
+        submit_to_service(args.service_url, service_rows, service_header)
+        send_notification(error_log_name)
+        sys.exit(0)
+
+    # Find the CMS accounts available in the Key Vault
+    accounts = discover_cms_accounts(secret_client)
+    if not accounts:
+        raise SystemExit("No CMS accounts found in the Key Vault. Terminating...")
+    worker_ceiling = min(args.thread_count or max_workers, len(accounts))
+    add_to_report(f"Found {len(accounts)} CMS accounts. Using up to {worker_ceiling} threads")
+
+    # Lease the accounts and their mailboxes on this host, so that other instances of the script only use the free ones.
+    # The leases are released on exit, and expire if the script is killed.
+    leases = LeaseManager(args.lease_file)
+    leases.start()
+    atexit.register(leases.stop)
+    resources = {account: account_resources(secret_client, account) for account in accounts}
+    tuner = WorkerPoolTuner(accounts, worker_ceiling, acquire=lambda account: leases.acquire(account, resources[account]), release=leases.release)
+
+    # Pause the lookups of an account, or of all of them, while the portal keeps failing, and kill browsers that hang
+    account_breakers = {account: CircuitBreaker(f"account {account}", args.breaker_failures, args.breaker_probe_interval, add_to_report) for account in accounts}
+    global_breaker = CircuitBreaker("all accounts", args.global_breaker_failures, args.breaker_probe_interval, add_to_report)
+    watchdog = BrowserWatchdog(args.lookup_deadline, on_kill=add_to_report)
+    watchdog.start()
+
+    # Open the result cache shared with the other runs of the day
+    result_cache = None if args.no_cache else ResultCache(cache_file_name, args.cache_ttl * 60 * 60, args.cache_size)
     
-    # Split the CSV file into parts
-    csv_parts, header = split_csv_file(csv_file_path, num_parts)
+    # Read the CSV file and prepare the scheduler with the time budget (if any). In pipeline mode
+    # the policies are fetched once the threads are logging in, and handed out as soon as they are scored.
+    # When serving, the rows are the lookups requested through the API.
+    rows = None
+    if args.tier is None and args.serve is None:
+        rows, header = read_csv_file(csv_file_path)
+    else:
+        header = policy_columns
+    deadline = time.monotonic() + args.deadline * 60 if args.deadline is not None else None
+    scheduler = LookupScheduler(deadline, streaming=args.tier is not None or args.sample is not None or args.serve is not None)
     
     # Create a ThreadPoolExecutor
-    with ThreadPoolExecutor(max_workers=num_parts) as executor:
-        # Schedule the thread_function for each part
-        futures = [executor.submit(thread_function, part_num) for part_num in range(1, num_parts + 1)]
-
-        # Wait for all threads to complete
-        for future in futures:
-            future.result()
-        
-        # Check if all threads have completed successfully
-        all_threads_successful = all(future.done() and future.exception() is None for future in futures)
+    with ThreadPoolExecutor(max_workers=worker_ceiling) as executor:
+        # Start with a conservative number of threads. The threads log in while the rows are being fetched (--tier) and scored.
+        futures = []
+        for _ in range(min(args.initial_workers, worker_ceiling)):
+            start_thread(executor, futures)
+
+        # Every account may be in use by other instances, wait for one to be released if asked to
+        wait_until = time.monotonic() + args.wait_for_accounts * 60
+        while not futures and time.monotonic() < wait_until:
+            print("All CMS accounts are in use by other instances, waiting for one to be released")
+            time.sleep(lease_poll)
+            start_thread(executor, futures)
+        if not futures:
+            raise SystemExit("All CMS accounts are in use by other instances of the script. Terminating...")
+
+        if args.serve is not None:
+            # Answer lookups through the API until the service is stopped (Ctrl+C or SIGTERM)
+            contract_directory = load_contract_directory('contract_directory.xlsx')
+            service = LookupService(lambda mbi: scheduler.push(service_row(mbi), service_priority), result_cache.get if result_cache is not None else None, coalesce_window, service_timeout)
+            server = start_server(service_host, args.serve, handle_service_lookup, service_status)
+            signal.signal(signal.SIGTERM, stop_serving)
+            add_to_report(f"MARx lookup service listening on http://{service_host}:{args.serve}")
+        else:
+            # The rows are fetched, scored and sampled next to the tuner, so threads are added meanwhile
+            scheduling_executor = ThreadPoolExecutor(max_workers=1)
+            scheduling = scheduling_executor.submit(profiled(schedule_input_rows), rows, futures)
+            scheduling_executor.shutdown(wait=False)
 
-        # Set send_email to True if all threads were successful
-        send_email = all_threads_successful
+        # Add or remove threads based on the observed latency and error rate until all of them have completed
+        try:
+            tune_worker_pool(executor, futures)
+            if args.serve is None:
+                # Raises the error that stopped the scheduling, i.e. when the policies could not be fetched
+                scheduling.result()
+        except KeyboardInterrupt:
+            if args.serve is None:
+                raise
+            # Stop taking requests and let the threads finish the lookups already queued
+            add_to_report("Stopping the MARx lookup service")
+            server.shutdown()
+            scheduler.close()
+
+        # Wait for all threads to complete. The threads that stopped on an error are listed in the report,
+        # and the rows they did not look up are deferred.
+        wait(futures)
+        failed_threads = sum(1 for future in futures if future.exception() is not None)
+        if failed_threads:
+            add_to_report(f"{failed_threads} of {len(futures)} threads stopped on an error")
+
+    watchdog.stop()
+
+    # Report the rows that were not reached before the deadline and the cache hit rate
+    if args.serve is None:
+        write_deferred_rows(scheduler, header)
+    else:
+        add_to_report(f"MARx lookup service: {service.stats()['requested']} lookups requested, {service.stats()['coalesced']} shared with an identical request")
+    if result_cache is not None:
+        add_to_report(result_cache.summary())
+        result_cache.close()
+    if sampler is not None:
+        drift_file_name = f"MARx_Drift_{datetime.now().strftime('%m_%d_%Y_%H%M')}_{csv_file_name}"
+        sampler.write_report(drift_file_name)
+        add_to_report(f"{sampler.summary()}. Strata written to {drift_file_name}")
         
     #----------------------------------
     # SEND EMAIL NOTIFICATION TO AGENTS
-    # UPON SUCCESSFUL EXECUTION
+    # UPON COMPLETION
     #----------------------------------
     
-    if send_email:
-        # Send out notification email if all the threads executed successfully.
-        send_notification(error_log_name)
+    # Send out notification email, with the threads that stopped on an error in the report
+    send_notification(error_log_name)
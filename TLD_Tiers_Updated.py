@@ -8,47 +8,44 @@ from azure.keyvault.secrets import SecretClient
 from dotenv import load_dotenv
 import os
 
-# Create an argument parser
-parser = argparse.ArgumentParser(description="Filter and process policies based on selected tier")
-parser.add_argument("selected_tier", type=int, choices=[1, 2, 3], help="Select a tier (1, 2, or 3)")
+# Endpoint URL
+url = "https://cm.tldcrm.com/api/egress/policies"
 
-# Parse the command-line arguments
-args = parser.parse_args()
-selected_tier = args.selected_tier
+# Columns of the policies, in the order MARX.py reads them
+policy_columns = ["policy_id", "policy_number", "lead_id", "lead_medicare_claim_number", "date_effective", "date_sold"]
+params = {
+    "columns": ", ".join(policy_columns),
+    "limit": "0",
+    "status_id": "1"
+}
 
-# Load Azure Keyvault Related Variables from .env file
-load_dotenv()
-client_id = os.environ['AZURE_CLIENT_ID']
-client_secret = os.environ['AZURE_CLIENT_SECRET']
-tenant_id = os.environ['AZURE_TENANT_ID']
-vault_url = os.environ['AZURE_VAULT_URL']
+# Output file of each tier
+tier_file_names = {1: "Tier1_Policies.csv", 2: "Tier2_Policies.csv", 3: "Tier3_Policies.csv"}
 
 def azure_authenticate(client_id, client_secret, tenant_id, vault_url):
     credentials = ClientSecretCredential(client_id=client_id, client_secret=client_secret, tenant_id=tenant_id)
     secret_client = SecretClient(vault_url=vault_url, credential=credentials)
     return secret_client
 
-# Endpoint URL
-url = "https://cm.tldcrm.com/api/egress/policies"
-params = {
-    "columns": "policy_id, policy_number, lead_id, lead_medicare_claim_number, date_effective, date_sold",
-    "limit": "0",
-    "status_id": "1"
-}
+def fetch_policies(secret_client):
+    # This method returns the active policies from TLD-CRM, or None if the request failed
+    headers = {
+        'tld-api-id': secret_client.get_secret('tld-api-id').value,
+        'tld-api-key': secret_client.get_secret('tld-api-key').value,
+        'Cookie': secret_client.get_secret('cookie-value').value
+    }
 
-# Authenticate with Azure Keyvault and retrieve a secret_client
-secret_client = azure_authenticate(client_id, client_secret, tenant_id, vault_url)
-headers = {
-    'tld-api-id': secret_client.get_secret('tld-api-id').value,
-    'tld-api-key': secret_client.get_secret('tld-api-key').value,
-    'Cookie': secret_client.get_secret('cookie-value').value
-}
+    response = requests.get(url, params=params, headers=headers)
 
-response = requests.get(url, params=params, headers=headers)
+    if response.status_code != 200:
+        print(f"Failed to retrieve data with status code {response.status_code}. Reason: {response.text}")
+        return None
 
-if response.status_code == 200:
     data = response.json()
-    records = data.get('response', {}).get('results', [])
+    return data.get('response', {}).get('results', [])
+
+def filter_tier(records, selected_tier):
+    # This method keeps the latest policy of each Medicare Number and returns the ones in the selected tier
 
     # Track the latest policy_id for each unique lead_medicare_claim_number
     latest_policy_id = {}
@@ -78,18 +75,16 @@ if response.status_code == 200:
 
     if selected_tier == 1:
         # Filter Tier 1: Date_effective > today's date
-        csv_filename = "Tier1_Policies.csv"
         current_date = datetime.now()
         filtered_records = [record for record in filtered_records if
                             record['date_effective'] is not None and
                             datetime.strptime(record['date_effective'], "%Y-%m-%d").date() >= current_date.date()]
-                            
+
         # Sort records by date_sold in descending order
         filtered_records.sort(key=lambda x: datetime.strptime(x['date_sold'], "%Y-%m-%d %H:%M:%S"), reverse=True)
 
     elif selected_tier == 2:
         # Filter Tier 2: Date_effective older than today's date and within the past 90 days
-        csv_filename = "Tier2_Policies.csv"
         current_date = datetime.now()
         past_90_days = current_date - timedelta(days=90)
         filtered_records = [record for record in filtered_records if
@@ -99,24 +94,49 @@ if response.status_code == 200:
 
     elif selected_tier == 3:
         # Filter Tier 3: Date_effective older than 90 days
-        csv_filename = "Tier3_Policies.csv"
         current_date = datetime.now()
         past_90_days = current_date - timedelta(days=90)
         filtered_records = [record for record in filtered_records if
                             record['date_effective'] is not None and
                             datetime.strptime(record['date_effective'], "%Y-%m-%d").date() < past_90_days.date()]
 
-    if filtered_records:
-        # Write the filtered records to a CSV file
-        with open(csv_filename, 'w', encoding='utf-8', newline='') as csvfile:
-            fieldnames = filtered_records[0].keys()
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-            writer.writeheader()
-            for record in filtered_records:
-                writer.writerow(record)
-
-        print(f"Filtered records written to {csv_filename}")
-    else:
-        print("No filtered records to write.")
-else:
-    print(f"Failed to retrieve data with status code {response.status_code}. Reason: {response.text}")
\ No newline at end of file
+    return filtered_records
+
+def write_tier_csv(csv_filename, filtered_records):
+    # Write the filtered records to a CSV file
+    with open(csv_filename, 'w', encoding='utf-8', newline='') as csvfile:
+        fieldnames = filtered_records[0].keys()
+        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+        writer.writeheader()
+        for record in filtered_records:
+            writer.writerow(record)
+
+if __name__ == "__main__":
+    # Create an argument parser
+    parser = argparse.ArgumentParser(description="Filter and process policies based on selected tier")
+    parser.add_argument("selected_tier", type=int, choices=[1, 2, 3], help="Select a tier (1, 2, or 3)")
+
+    # Parse the command-line arguments
+    args = parser.parse_args()
+    selected_tier = args.selected_tier
+
+    # Load Azure Keyvault Related Variables from .env file
+    load_dotenv()
+    client_id = os.environ['AZURE_CLIENT_ID']
+    client_secret = os.environ['AZURE_CLIENT_SECRET']
+    tenant_id = os.environ['AZURE_TENANT_ID']
+    vault_url = os.environ['AZURE_VAULT_URL']
+
+    # Authenticate with Azure Keyvault and retrieve a secret_client
+    secret_client = azure_authenticate(client_id, client_secret, tenant_id, vault_url)
+
+    records = fetch_policies(secret_client)
+    if records is not None:
+        filtered_records = filter_tier(records, selected_tier)
+        csv_filename = tier_file_names[selected_tier]
+
+        if filtered_records:
+            write_tier_csv(csv_filename, filtered_records)
+            print(f"Filtered records written to {csv_filename}")
+        else:
+            print("No filtered records to write.")
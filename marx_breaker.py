@@ -0,0 +1,83 @@
+import threading
+import time
+
+#-----------------------
+# VARIABLES DECLARATIONS
+#-----------------------
+
+# States of a circuit breaker
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+#----------------------
+# FUNCTION DECLARATIONS
+#----------------------
+class CircuitBreaker:
+    # Pauses the lookups after 'failure_threshold' failed lookups in a row. Once open, no lookup
+    # is let through for 'probe_interval' seconds, then a single probe lookup is (half-open).
+    # The breaker closes when the probe succeeds and opens for another interval when it fails.
+    # A probe with no result after 'probe_interval' seconds is taken as lost and another one is let through.
+
+    def __init__(self, name, failure_threshold=5, probe_interval=120, on_change=None):
+        # 'on_change' is called with a message every time the breaker changes state
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.probe_interval = probe_interval
+        self.on_change = on_change
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.probe_started = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        # Returns whether a lookup can be submitted. While half-open, only the probe lookup is allowed.
+        with self.lock:
+            if self.state == CLOSED:
+                return True
+
+            now = time.monotonic()
+            if self.state == OPEN:
+                if now - self.opened_at < self.probe_interval:
+                    return False
+                self.change(HALF_OPEN, f"probing the portal after {now - self.opened_at:.0f}s")
+            elif self.probe_started is not None and now - self.probe_started < self.probe_interval:
+                return False
+
+            self.probe_started = now
+            return True
+
+    def would_allow(self):
+        # Returns whether allow() would let a lookup through, without starting a probe
+        with self.lock:
+            now = time.monotonic()
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN:
+                return now - self.opened_at >= self.probe_interval
+            return self.probe_started is None or now - self.probe_started >= self.probe_interval
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            if self.state != CLOSED:
+                self.change(CLOSED, "a lookup succeeded, resuming")
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == HALF_OPEN:
+                self.change(OPEN, "the probe lookup failed")
+            elif self.state == CLOSED and self.failures >= self.failure_threshold:
+                self.change(OPEN, f"{self.failures} failed lookups in a row, pausing for {self.probe_interval:.0f}s")
+
+    def change(self, state, reason):
+        # Called with the lock held
+        self.state = state
+        self.probe_started = None
+        if state == OPEN:
+            self.opened_at = time.monotonic()
+        if self.on_change is not None:
+            self.on_change(f"Circuit breaker for {self.name} is {state}: {reason}")
@@ -0,0 +1,202 @@
+from selenium import webdriver
+from selenium.webdriver.chrome.options import Options
+import os
+import signal
+import time
+
+#-----------------------
+# VARIABLES DECLARATIONS
+#-----------------------
+
+# Resources the lean profile does not download. Stylesheets are still loaded, the MARx
+# menus rely on them to show and hide the Beneficiaries and Eligibility links.
+blocked_resource_patterns = [
+    "*.png", "*.jpg", "*.jpeg", "*.gif", "*.svg", "*.ico", "*.webp",
+    "*.woff", "*.woff2", "*.ttf", "*.otf", "*.eot",
+    "*.mp4", "*.webm", "*.mp3",
+]
+
+# Third-party hosts loaded by the CMS portal that are not needed for a lookup
+blocked_host_patterns = [
+    "*google-analytics.com*", "*googletagmanager.com*", "*doubleclick.net*",
+    "*adobedtm.com*", "*demdex.net*", "*omtrdc.net*",
+    "*newrelic.com*", "*nr-data.net*", "*dynatrace.com*",
+    "*qualtrics.com*", "*hotjar.com*", "*fonts.googleapis.com*", "*fonts.gstatic.com*",
+]
+
+# Chrome switches of the lean profile, capping cache and renderer memory and turning off
+# the features a scraping session never uses
+lean_arguments = [
+    "--window-size=1280,800",
+    "--disable-gpu",
+    "--disable-extensions",
+    "--disable-default-apps",
+    "--disable-sync",
+    "--disable-background-networking",
+    "--disable-component-update",
+    "--disable-client-side-phishing-detection",
+    "--disable-features=OptimizationHints,MediaRouter,Translate,AutofillServerCommunication,InterestFeedContentSuggestions",
+    "--blink-settings=imagesEnabled=false",
+    "--mute-audio",
+    "--no-first-run",
+    "--disk-cache-size=33554432",
+    "--media-cache-size=1",
+    "--renderer-process-limit=2",
+    "--js-flags=--max-old-space-size=256",
+]
+
+# Memory samples between scans of /proc for the processes of a session. Scanning reads every
+# process on the host, the samples in between only read the processes found by the last scan.
+pid_scan_interval = 20
+
+
+#----------------------
+# FUNCTION DECLARATIONS
+#----------------------
+def build_chrome_options(lean=False, profile_dir=None):
+    # This method returns the Chrome options for a session. The lean profile cuts down what
+    # the browser downloads and keeps in memory, and 'profile_dir' is reused between runs
+    # so that the scripts and stylesheets of the portal stay in the disk cache.
+    chrome_options = Options()
+    chrome_options.add_argument("--headless")
+
+    if lean:
+        for argument in lean_arguments:
+            chrome_options.add_argument(argument)
+        chrome_options.add_experimental_option("prefs", {
+            "profile.managed_default_content_settings.images": 2,
+            "profile.default_content_setting_values.notifications": 2,
+            "profile.default_content_setting_values.geolocation": 2,
+        })
+
+    if profile_dir:
+        chrome_options.add_argument(f"--user-data-dir={os.path.abspath(profile_dir)}")
+
+    return chrome_options
+
+
+def process_rss(pid):
+    # Returns the resident memory of a process in bytes, read from /proc (Linux only)
+    try:
+        with open(f"/proc/{pid}/status") as status_file:
+            for line in status_file:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return 0
+
+
+def child_pids(pid):
+    # Returns the pids of every process started (directly or not) by 'pid', read from /proc
+    parents = {}
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/stat") as stat_file:
+                    # The command name is in brackets and may contain spaces, the parent pid follows it
+                    parents[int(entry)] = int(stat_file.read().rsplit(")", 1)[1].split()[1])
+            except (OSError, ValueError, IndexError):
+                continue
+
+    children = []
+    pending = [pid]
+    while pending:
+        parent = pending.pop()
+        for child, child_parent in parents.items():
+            if child_parent == parent:
+                children.append(child)
+                pending.append(child)
+    return children
+
+
+class MeasuredChrome(webdriver.Chrome):
+    # Chrome WebDriver that times every page load and every lookup (from submitting the Medicare
+    # Number to the classified results page) and samples the memory used by the chromedriver
+    # process and all the browser processes below it
+
+    def __init__(self, *args, blocked_patterns=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.page_load_times = []
+        self.lookup_times = []
+        self.peak_rss = 0
+        self.session_pids = None
+        self.samples_since_scan = 0
+        self.blocked_patterns = blocked_patterns
+        self.block_resources()
+
+    def block_resources(self):
+        # Blocks the resource types and hosts through the DevTools protocol. This only applies to
+        # the tab the driver is on, so it is called again for every tab opened afterwards.
+        if self.blocked_patterns:
+            self.execute_cdp_cmd("Network.enable", {})
+            self.execute_cdp_cmd("Network.setBlockedURLs", {"urls": self.blocked_patterns})
+
+    def get(self, url):
+        started = time.monotonic()
+        super().get(url)
+        self.page_load_times.append(time.monotonic() - started)
+        self.sample_rss()
+
+    def record_lookup(self, seconds):
+        self.lookup_times.append(seconds)
+
+    def sample_rss(self):
+        # Returns the current memory of the session in bytes and keeps track of the peak
+        if not os.path.isdir("/proc"):
+            return 0
+        try:
+            driver_pid = self.service.process.pid
+        except AttributeError:
+            return 0
+        if self.session_pids is None or self.samples_since_scan >= pid_scan_interval:
+            self.session_pids = [driver_pid] + child_pids(driver_pid)
+            self.samples_since_scan = 0
+        self.samples_since_scan += 1
+
+        process_rss_values = [process_rss(pid) for pid in self.session_pids]
+        if 0 in process_rss_values:
+            # A process of the session exited, scan again on the next sample
+            self.session_pids = None
+        rss = sum(process_rss_values)
+        self.peak_rss = max(self.peak_rss, rss)
+        return rss
+
+    def kill(self):
+        # Kills the browser processes and chromedriver without going through chromedriver,
+        # so that the calls blocked on a hung browser fail straight away
+        try:
+            driver_process = self.service.process
+        except AttributeError:
+            return
+        if os.path.isdir("/proc"):
+            for pid in reversed(child_pids(driver_process.pid)):
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except OSError:
+                    pass
+        driver_process.kill()
+
+    def summary(self):
+        # Returns a line with the memory, page load and lookup times of this session
+        self.sample_rss()
+        if self.page_load_times:
+            average_load = sum(self.page_load_times) / len(self.page_load_times)
+            loads = f"{len(self.page_load_times)} page loads averaging {average_load:.1f}s (slowest {max(self.page_load_times):.1f}s)"
+        else:
+            loads = "no page loads"
+        if self.lookup_times:
+            average_lookup = sum(self.lookup_times) / len(self.lookup_times)
+            lookups = f"{len(self.lookup_times)} results pages averaging {average_lookup:.1f}s after submitting (slowest {max(self.lookup_times):.1f}s)"
+        else:
+            lookups = "no results pages"
+        # The memory is only read from /proc, so it is not available outside Linux
+        rss = f"peak RSS {self.peak_rss / (1024 * 1024):.0f} MB" if self.peak_rss else "RSS unavailable"
+        return f"{rss}, {loads}, {lookups}"
+
+
+def launch_browser(lean=False, profile_dir=None):
+    # This method starts a Chrome session, with the lean profile if requested
+    chrome_options = build_chrome_options(lean, profile_dir)
+    blocked_patterns = blocked_resource_patterns + blocked_host_patterns if lean else None
+    return MeasuredChrome(options=chrome_options, blocked_patterns=blocked_patterns)
@@ -0,0 +1,93 @@
+import json
+import sqlite3
+import threading
+import time
+from datetime import date
+
+#-----------------------
+# VARIABLES DECLARATIONS
+#-----------------------
+
+# Outcomes of a MARx lookup that can be cached
+RECORD = "record"
+NOT_ENROLLED = "not enrolled"
+INVALID_MBI = "invalid MBI"
+NOT_FOUND = "not found"
+
+# Outcome of a results page that has not loaded yet, never cached
+UNKNOWN = "unknown"
+
+
+#----------------------
+# FUNCTION DECLARATIONS
+#----------------------
+def normalize_mbi(mbi):
+    # This method returns the Medicare Number without dashes or spaces, in upper case
+    return mbi.replace('-', '').replace(' ', '').strip().upper()
+
+
+class ResultCache:
+    # Persistent cache of MARx lookup results, keyed by Medicare Number and lookup date, so
+    # that an MBI looked up earlier in the day (another Tier file, a rerun or a custom CSV)
+    # is not scraped again. Entries expire after 'ttl' seconds and the least recently used
+    # entries are evicted once there are more than 'max_entries'. Several instances of the script
+    # can share the file, a write waits up to 'busy_timeout' seconds for another one to finish.
+
+    def __init__(self, path, ttl=12 * 60 * 60, max_entries=50000, busy_timeout=30):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = {}
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=busy_timeout, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS marx_results ("
+                "mbi TEXT NOT NULL, lookup_date TEXT NOT NULL, outcome TEXT NOT NULL, "
+                "data TEXT, stored_at REAL NOT NULL, last_used REAL NOT NULL, "
+                "PRIMARY KEY (mbi, lookup_date))"
+            )
+            self.connection.execute("DELETE FROM marx_results WHERE stored_at < ?", (time.time() - self.ttl,))
+
+    def get(self, mbi):
+        # Returns a tuple of (outcome, data) for a result stored today, or None
+        key = (normalize_mbi(mbi), date.today().isoformat())
+        with self.lock, self.connection:
+            entry = self.connection.execute(
+                "SELECT outcome, data, stored_at FROM marx_results WHERE mbi = ? AND lookup_date = ?", key
+            ).fetchone()
+
+            if entry is None or entry[2] < time.time() - self.ttl:
+                self.misses += 1
+                return None
+
+            self.connection.execute("UPDATE marx_results SET last_used = ? WHERE mbi = ? AND lookup_date = ?", (time.time(),) + key)
+            self.hits[entry[0]] = self.hits.get(entry[0], 0) + 1
+            return entry[0], json.loads(entry[1]) if entry[1] is not None else None
+
+    def put(self, mbi, outcome, data=None):
+        # Stores the outcome of a lookup, with the parsed eligibility record if there is one
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO marx_results (mbi, lookup_date, outcome, data, stored_at, last_used) VALUES (?, ?, ?, ?, ?, ?)",
+                (normalize_mbi(mbi), date.today().isoformat(), outcome, json.dumps(data, default=str) if data is not None else None, now, now)
+            )
+            self.connection.execute(
+                "DELETE FROM marx_results WHERE rowid IN (SELECT rowid FROM marx_results ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+
+    def summary(self):
+        # Returns a line with the hit rate of this run, broken down by outcome
+        with self.lock:
+            total_hits = sum(self.hits.values())
+            total = total_hits + self.misses
+            if total == 0:
+                return "MARx cache: no lookups"
+            breakdown = ", ".join(f"{count} {outcome}" for outcome, count in sorted(self.hits.items()))
+            return f"MARx cache: {total_hits} hits out of {total} lookups ({total_hits / total:.0%})" + (f" - {breakdown}" if breakdown else "")
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
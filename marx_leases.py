@@ -0,0 +1,96 @@
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+
+class LeaseManager:
+    # Host-level leases on the CMS accounts and their mailboxes, shared by every MARX.py instance
+    # through a SQLite file. A resource (an account or a mailbox) is leased by one account of one
+    # instance at a time. The leases are renewed by a heartbeat thread and released on exit. The
+    # leases of an instance that stopped without releasing them expire after 'ttl' seconds, or
+    # straight away once its process is gone (same POSIX host only).
+
+    def __init__(self, path, ttl=120, heartbeat_interval=30):
+        self.ttl = ttl
+        self.heartbeat_interval = heartbeat_interval
+        self.hostname = socket.gethostname()
+        self.owner = f"{self.hostname}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.heartbeat = threading.Thread(target=self.renew_leases, name="lease-heartbeat", daemon=True)
+        self.connection = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        with self.lock:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS leases ("
+                "resource TEXT PRIMARY KEY, owner TEXT NOT NULL, holder TEXT NOT NULL, "
+                "hostname TEXT NOT NULL, pid INTEGER NOT NULL, acquired_at REAL NOT NULL, expires_at REAL NOT NULL)"
+            )
+
+    def start(self):
+        self.heartbeat.start()
+
+    def stop(self):
+        # Stops the heartbeat and releases every lease of this instance
+        self.stop_event.set()
+        if self.heartbeat.is_alive():
+            self.heartbeat.join()
+        with self.lock:
+            self.connection.execute("DELETE FROM leases WHERE owner = ?", (self.owner,))
+            self.connection.close()
+
+    def is_stale(self, hostname, pid, expires_at):
+        # A lease is stale once it expired, or when its process on this host is gone. On Windows
+        # os.kill() would send a signal to the process instead of checking it, so only expiry counts.
+        if expires_at < time.time():
+            return True
+        if hostname == self.hostname and os.name == "posix":
+            try:
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                return True
+            except OSError:
+                pass
+        return False
+
+    def acquire(self, holder, resources):
+        # Leases all the 'resources' for 'holder' (i.e an account number), or none of them.
+        # Returns whether the leases were taken.
+        now = time.time()
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                for resource in resources:
+                    lease = self.connection.execute(
+                        "SELECT owner, holder, hostname, pid, expires_at FROM leases WHERE resource = ?", (resource,)
+                    ).fetchone()
+                    if lease is not None and (lease[0], lease[1]) != (self.owner, str(holder)) and not self.is_stale(*lease[2:]):
+                        self.connection.execute("ROLLBACK")
+                        return False
+
+                for resource in resources:
+                    self.connection.execute(
+                        "INSERT OR REPLACE INTO leases (resource, owner, holder, hostname, pid, acquired_at, expires_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (resource, self.owner, str(holder), self.hostname, os.getpid(), now, now + self.ttl)
+                    )
+                self.connection.execute("COMMIT")
+                return True
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+
+    def release(self, holder):
+        # Releases the leases of 'holder'
+        with self.lock:
+            self.connection.execute("DELETE FROM leases WHERE owner = ? AND holder = ?", (self.owner, str(holder)))
+
+    def renew_leases(self):
+        while not self.stop_event.wait(self.heartbeat_interval):
+            try:
+                with self.lock:
+                    self.connection.execute("UPDATE leases SET expires_at = ? WHERE owner = ?", (time.time() + self.ttl, self.owner))
+            except sqlite3.Error as e:
+                # Retried on the next heartbeat, well before the leases expire
+                print(f"Could not renew the account leases: {e}")
@@ -0,0 +1,221 @@
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support.ui import WebDriverWait
+from selenium.webdriver.support import expected_conditions as EC
+from selenium.webdriver.common.keys import Keys
+from selenium.common.exceptions import WebDriverException
+import time
+from marx_cache import RECORD, NOT_ENROLLED, INVALID_MBI, NOT_FOUND, UNKNOWN, normalize_mbi
+from marx_recovery import LOGGED_OUT
+
+#-----------------------
+# VARIABLES DECLARATIONS
+#-----------------------
+
+# Seconds to leave the portal after submitting a Medicare Number before reading the results,
+# so that the results of the previous lookup are not read again
+settle_time = 5
+
+# Script classifying the MARx results page inside the browser, so that only the outcome, the
+# cells of the first results row and the Medicare Number the page is for are sent back instead
+# of the whole page source. The Medicare Number is taken from the text of the page (the results
+# heading), or from the input box when the page doesn't show it.
+classify_page_script = """
+var shownMbi = '';
+var mbiMatch = (document.body ? document.body.innerText : '').match(/\\b[1-9][A-Z][A-Z0-9][0-9]-?[A-Z][A-Z0-9][0-9]-?[A-Z]{2}[0-9]{2}\\b/);
+if (mbiMatch) { shownMbi = mbiMatch[0]; }
+else if (document.getElementById('claimNumber')) { shownMbi = document.getElementById('claimNumber').value; }
+var headings = Array.prototype.map.call(document.querySelectorAll('h2'), function (heading) { return heading.textContent.trim(); });
+if (headings.indexOf('Attention: The beneficiary ID is not a valid MBI number') >= 0) { return ['%s', [], shownMbi]; }
+if (headings.indexOf('Attention: Beneficiary not found') >= 0) { return ['%s', [], shownMbi]; }
+var table = document.querySelector('table.eligTable7');
+if (table) {
+    var rows = table.querySelectorAll('tr');
+    for (var i = 0; i < rows.length; i++) {
+        var cells = Array.prototype.map.call(rows[i].querySelectorAll('td'), function (cell) { return cell.textContent.trim(); });
+        if (cells.length) {
+            return [cells[0].indexOf('The beneficiary is not currently enrolled in any plan') >= 0 ? '%s' : '%s', cells, shownMbi];
+        }
+    }
+}
+return ['%s', [], shownMbi];
+""" % (INVALID_MBI, NOT_FOUND, NOT_ENROLLED, RECORD, UNKNOWN)
+
+
+#----------------------
+# FUNCTION DECLARATIONS
+#----------------------
+def classify_results_page(driver):
+    # This method returns the outcome of a lookup, the cells of the first results row and the Medicare
+    # Number shown by the page in a single WebDriver round trip, or None while the results page has not
+    # loaded yet
+    outcome, first_row_data, shown_mbi = driver.execute_script(classify_page_script)
+    if outcome == UNKNOWN:
+        return None
+    return outcome, first_row_data, shown_mbi
+
+
+class ResultMismatch(Exception):
+    # Raised when the results page of a tab is for another Medicare Number than the one submitted in it
+    pass
+
+
+class LookupTab:
+    # A browser tab on the MARx Eligibility form, with the lookup it is working on (if any)
+
+    def __init__(self, handle):
+        self.handle = handle
+        self.lookup = None
+        self.started_at = None
+        self.submitted_at = None
+
+
+class TabPool:
+    # Lookup tabs of one logged-in CMS session. A Medicare Number is submitted in every tab
+    # before the results of the oldest one are read, so the portal works on several lookups
+    # while the script waits. With a single tab this is the same as one lookup at a time.
+
+    def __init__(self, driver, recovery):
+        self.driver = driver
+        self.recovery = recovery
+        self.tabs = [LookupTab(driver.current_window_handle)]
+        self.current = self.tabs[0]
+
+    def open_tabs(self, count):
+        # Opens up to 'count' more tabs on the Eligibility form and returns the number opened
+        opened = 0
+        for _ in range(count):
+            try:
+                self.driver.switch_to.new_window('tab')
+                self.current = LookupTab(self.driver.current_window_handle)
+                # The lean profile's blocked URLs don't carry over to a new tab
+                self.driver.block_resources()
+                self.recovery.recover()
+            except Exception as e:
+                print(f"Could not open another lookup tab: {type(e).__name__}")
+                self.close_current_tab()
+                break
+            self.tabs.append(self.current)
+            opened += 1
+        return opened
+
+    def activate(self, tab):
+        # Switches the driver to a tab and into the MARx iframe, unless it is already there
+        if tab is self.current:
+            return
+        self.driver.switch_to.window(tab.handle)
+        self.current = tab
+        iframe = WebDriverWait(self.driver, 10).until(EC.presence_of_element_located((By.ID, "obj_marxaws_wab_application")))
+        self.driver.switch_to.frame(iframe)
+
+    def idle_tabs(self):
+        return [tab for tab in self.tabs if tab.lookup is None]
+
+    def oldest_busy_tab(self):
+        busy_tabs = [tab for tab in self.tabs if tab.lookup is not None]
+        return min(busy_tabs, key=lambda tab: tab.submitted_at) if busy_tabs else None
+
+    def submit(self, tab, lookup):
+        # Enters the Medicare Number of 'lookup' in a tab without waiting for the results
+        tab.lookup = lookup
+        tab.started_at = time.monotonic()
+        tab.submitted_at = tab.started_at
+        self.activate(tab)
+
+        # Find and interact with the input_box
+        input_box = WebDriverWait(self.driver, 10).until(EC.presence_of_element_located((By.ID, "claimNumber")))
+        # Clear the input box
+        input_box.clear()
+        time.sleep(1)
+        # Input next medicare number
+        input_box.send_keys(lookup["mbi"])
+        time.sleep(1)
+        # Send "Enter/Return" key as input
+        input_box.send_keys(Keys.RETURN)
+        tab.submitted_at = time.monotonic()
+
+    def collect(self, tab):
+        # Waits up to 60 seconds for the results in a tab and returns the outcome and the first results row.
+        # Results for another Medicare Number (another tab's, or the previous lookup's still on screen)
+        # raise a ResultMismatch instead of being written to the lead of this one.
+        self.activate(tab)
+        remaining_settle_time = tab.submitted_at + settle_time - time.monotonic()
+        if remaining_settle_time > 0:
+            time.sleep(remaining_settle_time)
+        outcome, first_row_data, shown_mbi = WebDriverWait(self.driver, 60).until(classify_results_page)
+        self.driver.record_lookup(time.monotonic() - tab.submitted_at)
+        if shown_mbi and normalize_mbi(shown_mbi) != normalize_mbi(tab.lookup["mbi"]):
+            raise ResultMismatch(f"results page shows Medicare Number {shown_mbi}")
+        return outcome, first_row_data
+
+    def release(self, tab):
+        # Frees a tab and returns the lookup it was working on
+        lookup = tab.lookup
+        tab.lookup = None
+        tab.started_at = None
+        tab.submitted_at = None
+        return lookup
+
+    def recover(self, tab):
+        # Brings a tab back to the Eligibility form and returns the pages passed through
+        try:
+            self.activate(tab)
+        except Exception:
+            # The page is identified from wherever the tab is
+            pass
+        self.current = tab
+        return self.recovery.recover()
+
+    def refresh(self):
+        # Reloads every tab and brings it back to the Eligibility form, so that an idle session
+        # stays logged in. The tabs must not be working on a lookup.
+        for tab in self.tabs:
+            self.current = None
+            try:
+                self.activate(tab)
+            except Exception:
+                # The page is identified from wherever the tab is
+                self.current = tab
+            try:
+                self.recovery.reload()
+            except WebDriverException:
+                # Recovery identifies the page the reload stopped on
+                pass
+            self.recovery.recover()
+        self.activate_first_tab()
+
+    def close_current_tab(self):
+        # Closes the tab the driver is on and goes back to the first tab
+        try:
+            self.driver.close()
+        except Exception:
+            pass
+        self.current = None
+        self.activate_first_tab()
+
+    def activate_first_tab(self):
+        try:
+            self.activate(self.tabs[0])
+        except Exception:
+            # Recovery takes care of it on the next failed lookup
+            self.current = self.tabs[0]
+
+    def fall_back_to_one_tab(self):
+        # Closes every tab but the first one and returns the lookups they were working on
+        lookups = []
+        for tab in self.tabs[1:]:
+            if tab.lookup is not None:
+                lookups.append(self.release(tab))
+            try:
+                self.driver.switch_to.window(tab.handle)
+                self.driver.close()
+            except Exception:
+                pass
+        self.tabs = self.tabs[:1]
+        self.current = None
+        self.activate_first_tab()
+        return lookups
+
+    def should_fall_back(self, recovery_path, consecutive_failures, error=None):
+        # The portal is taken to reject parallel use when a tab was logged out, showed the results of
+        # another Medicare Number, or every tab failed in a row
+        return len(self.tabs) > 1 and (LOGGED_OUT in recovery_path or isinstance(error, ResultMismatch) or consecutive_failures >= len(self.tabs))
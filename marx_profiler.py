@@ -0,0 +1,162 @@
+import cProfile
+import io
+import linecache
+import os
+import pstats
+import sys
+import threading
+import time
+
+#-----------------------
+# VARIABLES DECLARATIONS
+#-----------------------
+
+WAITING = "waiting on browser/network"
+CPU = "CPU in Python"
+IDLE = "idle (waiting on other threads)"
+
+# Code in these files only waits on chromedriver, the CMS portal, TLD-CRM, Outlook or the Key Vault
+waiting_paths = [
+    os.sep + "selenium" + os.sep, os.sep + "urllib3" + os.sep, os.sep + "requests" + os.sep,
+    os.sep + "http" + os.sep, os.sep + "O365" + os.sep, os.sep + "azure" + os.sep, os.sep + "msal" + os.sep,
+    os.sep + "socket.py", os.sep + "ssl.py", os.sep + "selectors.py", os.sep + "subprocess.py",
+]
+
+# Code in these files only waits on the other threads
+idle_paths = [os.sep + "threading.py", os.sep + "queue.py", os.sep + "concurrent" + os.sep]
+
+# From Python 3.12 cProfile hooks into sys.monitoring, which allows a single active profile in the
+# whole interpreter, so the threads can't each have their own. Only the wall-clock samples are taken then.
+per_thread_profiles = sys.version_info < (3, 12)
+
+
+#----------------------
+# FUNCTION DECLARATIONS
+#----------------------
+def classify_stack(frames):
+    # This method tells where a thread spends a sample from its stack (innermost frame first).
+    # time.sleep() has no frame of its own, so a leaf line calling it also counts as waiting.
+    leaf = frames[0]
+    if "sleep(" in linecache.getline(leaf.f_code.co_filename, leaf.f_lineno):
+        return WAITING
+    for frame in frames:
+        filename = frame.f_code.co_filename
+        if any(path in filename for path in waiting_paths):
+            return WAITING
+    if any(path in leaf.f_code.co_filename for path in idle_paths):
+        return IDLE
+    return CPU
+
+
+class RunProfiler:
+    # Profiles every thread of a run. Each thread runs the wrapped functions under its own cProfile
+    # measuring CPU time (up to Python 3.11), and a sampling thread records the wall-clock stacks
+    # of all threads. Both are merged into one report when the run stops.
+
+    def __init__(self, sample_interval=0.02):
+        self.sample_interval = sample_interval
+        self.profiles = []
+        self.thread_profiles = threading.local()
+        self.stacks = {}
+        self.categories = {WAITING: 0, CPU: 0, IDLE: 0}
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.sampler = threading.Thread(target=self.sample, name="profiler", daemon=True)
+        self.main_profile = cProfile.Profile(time.thread_time) if per_thread_profiles else None
+
+    def start(self):
+        # Called from the main thread, which is profiled until stop()
+        self.started = time.monotonic()
+        if self.main_profile is not None:
+            self.main_profile.enable()
+        self.sampler.start()
+
+    def wrap(self, function):
+        # Returns 'function' running under the CPU profile of the thread that calls it. A thread
+        # keeps one profile for all the wrapped calls it makes, i.e. a pool thread fetching many rows.
+        if not per_thread_profiles:
+            return function
+
+        def profiled(*args, **kwargs):
+            profile = getattr(self.thread_profiles, "profile", None)
+            if profile is None:
+                profile = self.thread_profiles.profile = cProfile.Profile(time.thread_time)
+                self.thread_profiles.active = False
+                with self.lock:
+                    self.profiles.append(profile)
+            if self.thread_profiles.active:
+                # Already profiled by a wrapped call further up the stack
+                return function(*args, **kwargs)
+            self.thread_profiles.active = True
+            try:
+                return profile.runcall(function, *args, **kwargs)
+            finally:
+                self.thread_profiles.active = False
+        return profiled
+
+    def sample(self):
+        while not self.stop_event.wait(self.sample_interval):
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == self.sampler.ident:
+                    continue
+
+                frames = []
+                while frame is not None:
+                    frames.append(frame)
+                    frame = frame.f_back
+                category = classify_stack(frames)
+
+                # Collapsed stack format: outermost frame first, frames separated by ';'
+                names = [f"{os.path.basename(f.f_code.co_filename)}:{f.f_code.co_name}" for f in reversed(frames)]
+                stack = ";".join([thread_names.get(thread_id, str(thread_id)), category] + names)
+                with self.lock:
+                    self.stacks[stack] = self.stacks.get(stack, 0) + 1
+                    self.categories[category] += 1
+
+    def stop(self, report_path, collapsed_path):
+        # Stops profiling and writes the merged report and the flamegraph-compatible collapsed stacks
+        self.stop_event.set()
+        self.sampler.join()
+        elapsed = time.monotonic() - self.started
+
+        with self.lock:
+            stats_output = io.StringIO()
+            if self.main_profile is not None:
+                self.main_profile.disable()
+                stats = pstats.Stats(self.main_profile, stream=stats_output)
+                for profile in self.profiles:
+                    stats.add(profile)
+                stats.sort_stats("cumulative").print_stats(60)
+                profiled_threads = f"{len(self.profiles) + 1} profiled threads"
+            else:
+                stats_output.write(f"Not available on Python {sys.version_info.major}.{sys.version_info.minor}, see the wall-clock samples above\n")
+                profiled_threads = "wall-clock samples only"
+
+            total_samples = sum(self.categories.values()) or 1
+            with open(report_path, 'w', encoding='utf-8') as report_file:
+                report_file.write(f"MARx profile - {elapsed:.0f}s wall-clock, {profiled_threads}\n\n")
+
+                report_file.write("Wall-clock samples of all threads\n")
+                for category, count in self.categories.items():
+                    report_file.write(f"  {category}: {count} samples ({count / total_samples:.1%})\n")
+
+                # The top stacks merge the samples of all threads, only the collapsed file keeps them per thread
+                merged_stacks = {}
+                for stack, count in self.stacks.items():
+                    merged_stack = stack.split(";", 1)[1]
+                    merged_stacks[merged_stack] = merged_stacks.get(merged_stack, 0) + count
+
+                for category in [WAITING, CPU]:
+                    report_file.write(f"\nTop stacks - {category}\n")
+                    top_stacks = sorted(((count, stack) for stack, count in merged_stacks.items() if stack.split(";")[0] == category), reverse=True)[:15]
+                    for count, stack in top_stacks:
+                        # Only the innermost frames are shown here, the collapsed file has the full stacks
+                        report_file.write(f"  {count:>7}  {' <- '.join(reversed(stack.split(';')[1:]))[:300]}\n")
+
+                report_file.write("\nCPU time per function (all threads merged)\n")
+                report_file.write(stats_output.getvalue())
+
+            with open(collapsed_path, 'w', encoding='utf-8') as collapsed_file:
+                for stack, count in sorted(self.stacks.items()):
+                    collapsed_file.write(f"{stack} {count}\n")
@@ -0,0 +1,134 @@
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support.ui import WebDriverWait
+from selenium.webdriver.support import expected_conditions as EC
+from selenium.common.exceptions import WebDriverException
+import time
+
+#-----------------------
+# VARIABLES DECLARATIONS
+#-----------------------
+
+marx_url = 'https://portal.cms.gov/myportal/wps/myportal/cmsportal/marxaws/verticalRedirect/application'
+
+# Pages the browser can be on when a lookup fails
+ELIGIBILITY_READY = "Eligibility ready"
+RESULTS_PAGE = "Results page"
+ROLE_SELECTION = "Role selection"
+MENU_LEVEL = "Menu level"
+OUTSIDE_IFRAME = "Outside the iframe"
+LOGGED_OUT = "Logged out"
+PORTAL_ERROR = "Portal error"
+
+# Pages from which the next Medicare Number can be entered straight away
+ready_states = [ELIGIBILITY_READY, RESULTS_PAGE]
+
+
+class RecoveryError(Exception):
+    # Raised when the browser could not be brought back to the Eligibility form
+    pass
+
+
+#----------------------
+# FUNCTION DECLARATIONS
+#----------------------
+def detect_page_state(driver):
+    # This method identifies the page the browser is on without navigating anywhere.
+    # The MARx pages live inside an iframe, so the iframe is checked first and the
+    # portal page around it only if nothing from MARx is found.
+    try:
+        if driver.find_elements(By.ID, "claimNumber"):
+            if driver.find_elements(By.CSS_SELECTOR, "table.eligTable7") or driver.find_elements(By.XPATH, "//h2[starts-with(normalize-space(), 'Attention:')]"):
+                return RESULTS_PAGE
+            return ELIGIBILITY_READY
+        if driver.find_elements(By.XPATH, "//a[text()='Beneficiaries ']"):
+            return MENU_LEVEL
+        if driver.find_elements(By.ID, "userRole"):
+            return ROLE_SELECTION
+
+        # Nothing from MARx found. The iframe is only found from the portal page around it, so
+        # finding it here means the driver is outside of it. Otherwise the driver was inside
+        # the iframe on a page that is not part of MARx (an error or session timeout page).
+        if driver.find_elements(By.ID, "obj_marxaws_wab_application"):
+            return OUTSIDE_IFRAME
+        driver.switch_to.default_content()
+        if driver.find_elements(By.ID, "obj_marxaws_wab_application"):
+            return PORTAL_ERROR
+        if driver.find_elements(By.ID, "cms-login-userId"):
+            return LOGGED_OUT
+    except WebDriverException:
+        pass
+
+    return PORTAL_ERROR
+
+
+class EligibilityRecovery:
+    # Brings the browser back to a ready Eligibility form, taking the shortest path from
+    # the page it is on. Reloading MARx is only done on a portal error, and logging in
+    # again only when the session is gone or reloading did not help.
+
+    def __init__(self, driver, relogin, max_steps=10, max_reloads=2, max_relogins=1):
+        # 'relogin' is called with the driver and must leave it logged into the CMS portal
+        self.driver = driver
+        self.relogin = relogin
+        self.max_steps = max_steps
+        self.max_reloads = max_reloads
+        self.max_relogins = max_relogins
+
+    def recover(self):
+        # Returns the list of pages passed through on the way to the Eligibility form,
+        # or raises a RecoveryError if it could not be reached
+        path = []
+        reloads = 0
+        relogins = 0
+
+        for _ in range(self.max_steps):
+            state = detect_page_state(self.driver)
+            path.append(state)
+
+            if state in ready_states:
+                return path
+
+            try:
+                if state == MENU_LEVEL:
+                    self.open_eligibility()
+                elif state == ROLE_SELECTION:
+                    self.click(By.ID, "userRole")
+                    self.open_eligibility()
+                elif state == OUTSIDE_IFRAME:
+                    iframe = WebDriverWait(self.driver, 60).until(EC.presence_of_element_located((By.ID, "obj_marxaws_wab_application")))
+                    self.driver.switch_to.frame(iframe)
+                elif state == LOGGED_OUT or reloads >= self.max_reloads:
+                    # Escalate to logging in again
+                    if relogins >= self.max_relogins:
+                        break
+                    relogins += 1
+                    reloads = 0
+                    path.append("Logging in again")
+                    self.relogin(self.driver)
+                    self.reload()
+                else:
+                    reloads += 1
+                    path.append("Reloading MARx")
+                    self.reload()
+            except WebDriverException as e:
+                # The page changed under us, identify it again on the next step
+                path.append(type(e).__name__)
+
+        raise RecoveryError(f"Could not get back to the Eligibility form: {' -> '.join(path)}")
+
+    def reload(self):
+        self.driver.get(marx_url)
+        iframe = WebDriverWait(self.driver, 180).until(EC.presence_of_element_located((By.ID, "obj_marxaws_wab_application")))
+        self.driver.switch_to.frame(iframe)
+
+    def click(self, by, value):
+        button = WebDriverWait(self.driver, 20).until(EC.element_to_be_clickable((by, value)))
+        button.click()
+
+    def open_eligibility(self):
+        # The Eligibility link only shows once the Beneficiaries menu is open
+        if not self.driver.find_elements(By.XPATH, "//a[text()='Eligibility ']"):
+            self.click(By.XPATH, "//a[text()='Beneficiaries ']")
+        self.click(By.XPATH, "//a[text()='Eligibility ']")
+        WebDriverWait(self.driver, 20).until(EC.presence_of_element_located((By.ID, "claimNumber")))
+        time.sleep(1)
@@ -0,0 +1,102 @@
+from datetime import datetime
+
+#-----------------------
+# VARIABLES DECLARATIONS
+#-----------------------
+
+# Number of days after the sale date at which an unmatched policy is raised as an 'Alert'
+alert_threshold_days = 14
+
+# Prior statuses that are kept as they are
+settled_statuses = ['Resolved', 'Retained', 'Alert']
+
+
+#----------------------
+# FUNCTION DECLARATIONS
+#----------------------
+def evaluate_plan_change(policy_number, marx_contract, old_plan_result, old_last_update, date_delta_days):
+    # This method applies the alert rules to the MARx contract of a lead and returns a tuple of the
+    # new 'marx_plan_change_result' and whether a new 'Alert' was raised. 'old_plan_result' and
+    # 'old_last_update' are the values in TLD-CRM before the update, 'date_delta_days' is the number
+    # of days between the sale date and the MARx lookup.
+
+    # If Policy Number is blank, Nothing to compare!
+    if policy_number is None or policy_number == '':
+        return None, False
+
+    # If marx_contract exists in policy_number, we have a 'Match'.
+    if marx_contract in policy_number:
+        return 'match', False
+
+    # If we previously had a 'match' and the updated contract doesn't 'match', trigger an 'Alert'.
+    if old_plan_result == 'match' and marx_contract not in policy_number:
+        return 'Alert', True
+
+    # If a policy is on Resolved, Retained or Alert, keep as it is!
+    if old_plan_result in settled_statuses:
+        return old_plan_result, False
+
+    # If it's been 'alert_threshold_days' or more since the sale date and the policies still don't match, trigger an 'Alert'
+    if old_plan_result is None and old_last_update is not None and date_delta_days >= alert_threshold_days:
+        return 'Alert', True
+
+    # No conditionals match, revert policy to None
+    return None, False
+
+
+def replay_plan_changes(stored_results, policies):
+    # This method evaluates the alert rules again on stored MARx results, without the portal.
+    # 'stored_results' are the rows of MARx_Update.csv as dictionaries (only the latest row of each
+    # lead is used) and 'policies' maps policy_id to the rows of the policy CSV as dictionaries.
+    # Returns the leads whose status changes, and the number of leads evaluated and skipped.
+    latest_results = {}
+    for stored_result in stored_results:
+        latest_results[stored_result['lead_id']] = stored_result
+
+    changes = []
+    evaluated = 0
+    skipped = 0
+    for lead_id, stored_result in latest_results.items():
+        policy = policies.get(stored_result['policy_id'])
+
+        # Results written before the statuses were recorded cannot be replayed
+        if policy is None or not stored_result.get('marx_plan_change_result'):
+            skipped += 1
+            continue
+
+        try:
+            date_sold = datetime.strptime(stored_result['date_sold_in_tld'], "%Y-%m-%d %H:%M:%S").date()
+            lookup_date = datetime.strptime(stored_result['marx_last_udpate'], "%m/%d/%Y").date()
+        except ValueError:
+            skipped += 1
+            continue
+
+        # The rules are applied as of the day of the lookup
+        marx_plan_change_result, _ = evaluate_plan_change(
+            policy['policy_number'],
+            stored_result['marx_contract'],
+            stored_result['previous_plan_change_result'],
+            stored_result['previous_marx_last_udpate'],
+            (lookup_date - date_sold).days
+        )
+        evaluated += 1
+
+        # Results are stored as text, None included
+        if str(marx_plan_change_result) != stored_result['marx_plan_change_result']:
+            changes.append({
+                'lead_id': lead_id,
+                'policy_id': stored_result['policy_id'],
+                'policy_number': policy['policy_number'],
+                'marx_last_udpate': stored_result['marx_last_udpate'],
+                'marx_contract': stored_result['marx_contract'],
+                'marx_pbp': stored_result['marx_pbp'],
+                'marx_plan_code_desc': stored_result['marx_plan_code_desc'],
+                'marx_start_date': stored_result['marx_start_date'],
+                'marx_carrier_name': stored_result['marx_carrier_name'],
+                'marx_plan_type': stored_result['marx_plan_type'],
+                'previous_plan_change_result': stored_result['previous_plan_change_result'],
+                'stored_plan_change_result': stored_result['marx_plan_change_result'],
+                'replayed_plan_change_result': marx_plan_change_result,
+            })
+
+    return changes, evaluated, skipped
@@ -0,0 +1,193 @@
+import csv
+import math
+import random
+import re
+import threading
+import openpyxl
+
+#-----------------------
+# VARIABLES DECLARATIONS
+#-----------------------
+
+# Carrier and plan type of policies whose contract is not in contract_directory.xlsx
+UNKNOWN = "Unknown"
+
+# z-score of the 95% confidence bounds
+confidence_z = 1.96
+
+# Contract numbers (i.e H1234) as they appear in the policy numbers
+contract_pattern = re.compile(r"[A-Z]\d{4}")
+
+# Sale month at the start of date_sold, i.e 2024-03
+sale_month_pattern = re.compile(r"\d{4}-\d{2}")
+
+
+#----------------------
+# FUNCTION DECLARATIONS
+#----------------------
+def load_contract_directory(path):
+    # This method returns the carrier name and plan type of every contract number in the contract directory
+    workbook = openpyxl.load_workbook(path, read_only=True)
+    contracts = {}
+    for row in workbook.active.iter_rows(min_row=2, values_only=True):
+        if row[0]:
+            contracts[str(row[0]).strip()] = (row[1] or UNKNOWN, row[2] or UNKNOWN)
+    workbook.close()
+    return contracts
+
+
+def policy_stratum(policy_number, date_sold, contracts):
+    # This method returns the stratum of a policy: the carrier and plan type of the contract
+    # found in its policy number, and the month it was sold in
+    carrier, plan_type = UNKNOWN, UNKNOWN
+    for contract in contract_pattern.findall((policy_number or '').upper()):
+        if contract in contracts:
+            carrier, plan_type = contracts[contract]
+            break
+    sale_month = sale_month_pattern.match(date_sold or '')
+    return carrier, plan_type, sale_month.group() if sale_month else UNKNOWN
+
+
+def wilson_interval(successes, total, z=confidence_z):
+    # Returns the Wilson score confidence bounds of a proportion
+    if total == 0:
+        return 0.0, 1.0
+    proportion = successes / total
+    denominator = 1 + z * z / total
+    center = (proportion + z * z / (2 * total)) / denominator
+    margin = z * math.sqrt(proportion * (1 - proportion) / total + z * z / (4 * total * total)) / denominator
+    return max(0.0, center - margin), min(1.0, center + margin)
+
+
+def contract_changed(old_contract, old_pbp, marx_contract, marx_pbp):
+    # This method returns whether the MARx contract or PBP of a lead changed since its last update
+    # in TLD-CRM, or None for a lead that was never updated
+    if old_contract in ['', 'None'] and old_pbp in ['', 'None']:
+        return None
+    return (old_contract, old_pbp) != (marx_contract, marx_pbp)
+
+
+class StratifiedSampler:
+    # Splits the policies into strata (carrier, plan type and sale month) and draws a random
+    # sample of 'fraction' of each stratum, with at least 'min_per_stratum' policies. The drift
+    # rate is estimated from the sampled lookups. The rest of a stratum is escalated to a full
+    # scrape once its change rate crosses 'threshold'.
+
+    def __init__(self, rows, header, contracts, fraction, min_per_stratum=10, threshold=0.05, seed=None):
+        self.threshold = threshold
+        self.lock = threading.Lock()
+        self.strata = {}
+        self.sampled_policies = {}
+        self.escalations = []
+
+        strata_rows = {}
+        for row in rows:
+            key = policy_stratum(row[header.index('policy_number')], row[header.index('date_sold')], contracts)
+            strata_rows.setdefault(key, []).append(row)
+
+        randomizer = random.Random(seed)
+        for key, stratum_rows in sorted(strata_rows.items()):
+            sample_size = min(len(stratum_rows), max(min_per_stratum, math.ceil(fraction * len(stratum_rows))))
+            sample = randomizer.sample(stratum_rows, sample_size)
+            sampled_ids = {id(row) for row in sample}
+            self.strata[key] = {
+                "policies": len(stratum_rows),
+                "sample": sample,
+                "rest": [row for row in stratum_rows if id(row) not in sampled_ids],
+                "finished": 0,
+                "measured": 0,
+                "changed": 0,
+                "escalated": False,
+            }
+            for row in sample:
+                self.sampled_policies[row[header.index('policy_id')]] = key
+        self.policy_id_index = header.index('policy_id')
+
+    def sample_rows(self):
+        return [row for stratum in self.strata.values() for row in stratum["sample"]]
+
+    def record(self, row, changed):
+        # Records the result of a sampled lookup: True or False for a lead whose contract changed or not,
+        # None for a lookup that failed or can't tell. Rows outside the sample are ignored.
+        with self.lock:
+            key = self.sampled_policies.pop(row[self.policy_id_index], None)
+            if key is None:
+                return
+            stratum = self.strata[key]
+            stratum["finished"] += 1
+            if changed is not None:
+                stratum["measured"] += 1
+                stratum["changed"] += int(changed)
+
+            # Escalate as soon as the change rate of the stratum can no longer end up below the threshold
+            if stratum["changed"] > self.threshold * len(stratum["sample"]):
+                self.escalate(key)
+
+    def escalate(self, key):
+        # Called with the lock held
+        stratum = self.strata[key]
+        if not stratum["escalated"] and stratum["rest"]:
+            stratum["escalated"] = True
+            self.escalations.append(key)
+
+    def finish(self):
+        # Called once the sampled lookups are done, escalates the strata whose observed change rate crosses the threshold
+        with self.lock:
+            for key, stratum in self.strata.items():
+                if stratum["measured"] and stratum["changed"] / stratum["measured"] > self.threshold:
+                    self.escalate(key)
+
+    def take_escalations(self):
+        # Returns the strata escalated since the last call, with the rows that were not sampled
+        with self.lock:
+            escalations = [(key, self.strata[key]["rest"]) for key in self.escalations]
+            self.escalations = []
+        return escalations
+
+    def outstanding(self):
+        # Returns the number of sampled lookups that have not finished yet
+        with self.lock:
+            return len(self.sampled_policies)
+
+    def estimate(self):
+        # Returns the estimated drift rate of all the policies with its confidence bounds, or None
+        # without any sampled lookup. The rate and the Wilson bounds of each stratum are weighted
+        # by its number of policies, which keeps the bounds conservative for small samples.
+        with self.lock:
+            measured_strata = [stratum for stratum in self.strata.values() if stratum["measured"]]
+            total = sum(stratum["policies"] for stratum in measured_strata)
+            if total == 0:
+                return None
+
+            rate, lower, upper = 0.0, 0.0, 0.0
+            for stratum in measured_strata:
+                weight = stratum["policies"] / total
+                stratum_lower, stratum_upper = wilson_interval(stratum["changed"], stratum["measured"])
+                rate += weight * stratum["changed"] / stratum["measured"]
+                lower += weight * stratum_lower
+                upper += weight * stratum_upper
+
+        return rate, lower, upper
+
+    def write_report(self, path):
+        # Writes the change rate and confidence bounds of every stratum into a CSV file
+        with self.lock:
+            with open(path, 'w', newline='', encoding='utf-8') as report_file:
+                writer = csv.writer(report_file)
+                writer.writerow(['carrier_name', 'plan_type', 'sale_month', 'policies', 'sampled', 'looked_up', 'changed', 'change_rate', 'lower_bound', 'upper_bound', 'escalated'])
+                for (carrier, plan_type, sale_month), stratum in self.strata.items():
+                    lower, upper = wilson_interval(stratum["changed"], stratum["measured"])
+                    change_rate = f"{stratum['changed'] / stratum['measured']:.4f}" if stratum["measured"] else ''
+                    writer.writerow([carrier, plan_type, sale_month, stratum["policies"], len(stratum["sample"]), stratum["measured"], stratum["changed"], change_rate, f"{lower:.4f}", f"{upper:.4f}", stratum["escalated"]])
+
+    def summary(self):
+        # Returns a line with the estimated drift rate and the number of escalated strata
+        estimate = self.estimate()
+        with self.lock:
+            escalated = sum(1 for stratum in self.strata.values() if stratum["escalated"])
+            sampled = sum(len(stratum["sample"]) for stratum in self.strata.values())
+            total = sum(stratum["policies"] for stratum in self.strata.values())
+        if estimate is None:
+            return f"Drift check: no sampled lookups to estimate from ({sampled} of {total} policies sampled)"
+        rate, lower, upper = estimate
+        return f"Drift check: {sampled} of {total} policies sampled in {len(self.strata)} strata, estimated drift {rate:.1%} (95% bounds {lower:.1%} - {upper:.1%}), {escalated} strata escalated to a full scrape"
@@ -0,0 +1,90 @@
+import heapq
+import itertools
+import threading
+import time
+from marx_rules import settled_statuses
+
+
+#----------------------
+# FUNCTION DECLARATIONS
+#----------------------
+def priority_score(prior_status, policy_number):
+    # This method scores a row by how likely its MARx lookup is to change the
+    # 'marx_plan_change_result' of the lead. Higher scores are looked up first.
+    # The days since the sale don't count: TLD-CRM returns the blank statuses as text, so
+    # the 14-day alert rule never applies to them and they can only become a 'match'.
+
+    # Without a Policy Number there is nothing to compare, the result is always None
+    if policy_number is None or policy_number == '':
+        return 0
+
+    # A previous 'match' is the only status that can flip straight to 'Alert'
+    if prior_status == 'match':
+        return 100
+
+    # Resolved, Retained and Alert are kept as they are unless the contract matches again
+    if prior_status in settled_statuses:
+        return 10
+
+    return 20
+
+
+class LookupScheduler:
+    # Priority queue shared by all the worker threads. Rows are handed out highest
+    # score first (file order between equal scores) until the queue is empty or the
+    # deadline has passed. Rows left over at the deadline are kept as 'deferred'.
+    # In streaming mode rows are handed out as soon as they are pushed, so the
+    # priority only applies between the rows queued at the time.
+
+    def __init__(self, deadline=None, streaming=False):
+        # 'deadline' is a time.monotonic() value, or None to run until the queue is empty
+        self.deadline = deadline
+        self.streaming = streaming
+        self.heap = []
+        self.counter = itertools.count()
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def push(self, item, score):
+        with self.condition:
+            # heapq is a min-heap, so the score is negated to pop the highest first
+            heapq.heappush(self.heap, (-score, next(self.counter), item))
+            self.condition.notify()
+
+    def close(self):
+        # Marks that no more rows will be pushed, releasing any waiting workers
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def deadline_passed(self):
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def pop(self, block=True, timeout=None):
+        # Returns the next row to look up, or None once the queue is exhausted or the
+        # deadline has passed. Waits until the queue is closed, so that every row has
+        # been scored before the first one is handed out, or in streaming mode until
+        # there is a row to hand out. Without 'block', returns None instead of waiting,
+        # and with a 'timeout', once it has waited that many seconds.
+        with self.condition:
+            while not self.closed and not (self.streaming and self.heap):
+                if not block or not self.condition.wait(timeout):
+                    return None
+            if not self.heap or self.deadline_passed():
+                return None
+            return heapq.heappop(self.heap)[2]
+
+    def exhausted(self):
+        # Returns whether no more rows will be handed out
+        with self.condition:
+            return self.deadline_passed() or (self.closed and not self.heap)
+
+    def pending(self):
+        # Returns the number of rows that have not been handed out yet
+        with self.condition:
+            return len(self.heap)
+
+    def deferred(self):
+        # Returns the rows that were not handed out, highest priority first
+        with self.condition:
+            return [entry[2] for entry in sorted(self.heap)]
@@ -0,0 +1,157 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import requests
+from marx_cache import normalize_mbi
+
+#-----------------------
+# VARIABLES DECLARATIONS
+#-----------------------
+
+# Outcomes of a service lookup that did not get a result from MARx
+FAILED = "failed"
+TIMED_OUT = "timed out"
+
+
+#----------------------
+# FUNCTION DECLARATIONS
+#----------------------
+class PendingLookup:
+    # Result of a Medicare Number lookup, shared by every request waiting on it
+
+    def __init__(self, mbi):
+        self.mbi = mbi
+        self.outcome = None
+        self.data = None
+        self.error = None
+        self.started_at = time.monotonic()
+        self.finished_at = None
+        self.event = threading.Event()
+
+    def finish(self, outcome, data=None, error=None):
+        self.outcome = outcome
+        self.data = data
+        self.error = error
+        self.finished_at = time.monotonic()
+        self.event.set()
+
+    def wait(self, timeout):
+        # Returns whether the lookup finished within 'timeout' seconds
+        return self.event.wait(timeout)
+
+
+class LookupService:
+    # Hands the Medicare Numbers requested through the service to the warm MARx sessions. Requests
+    # for a Medicare Number that is already being looked up, or was looked up in the last
+    # 'coalesce_window' seconds, share that lookup instead of going to the portal again. A lookup
+    # that has not finished within 'lookup_timeout' seconds is given up, and the next request for
+    # its Medicare Number starts a new one.
+
+    def __init__(self, submit, cache_lookup=None, coalesce_window=30, lookup_timeout=600):
+        # 'submit' is called with a Medicare Number that needs a portal lookup. 'cache_lookup' returns
+        # a tuple of (outcome, data) for a Medicare Number looked up earlier today, or None.
+        self.submit = submit
+        self.cache_lookup = cache_lookup
+        self.coalesce_window = coalesce_window
+        self.lookup_timeout = lookup_timeout
+        self.lookups = {}
+        self.requested = 0
+        self.coalesced = 0
+        self.lock = threading.Lock()
+
+    def request(self, mbi):
+        # Returns the PendingLookup of a Medicare Number, starting a lookup if needed
+        mbi = normalize_mbi(mbi)
+        now = time.monotonic()
+        with self.lock:
+            self.requested += 1
+            # Forget the lookups finished outside of the coalescing window, and give up the ones that
+            # did not finish in time (i.e. dropped by a thread that stopped)
+            for expired_mbi, lookup in list(self.lookups.items()):
+                if lookup.finished_at is None and now - lookup.started_at > self.lookup_timeout:
+                    lookup.finish(TIMED_OUT, error="The lookup did not finish in time")
+                    del self.lookups[expired_mbi]
+                elif lookup.finished_at is not None and now - lookup.finished_at > self.coalesce_window:
+                    del self.lookups[expired_mbi]
+
+            if mbi in self.lookups:
+                self.coalesced += 1
+                return self.lookups[mbi]
+            pending = PendingLookup(mbi)
+            self.lookups[mbi] = pending
+
+        cached_result = self.cache_lookup(mbi) if self.cache_lookup is not None else None
+        if cached_result is not None:
+            pending.finish(*cached_result)
+        else:
+            self.submit(mbi)
+        return pending
+
+    def resolve(self, mbi, outcome, data):
+        # Called by the worker threads with the result of a portal lookup
+        with self.lock:
+            pending = self.lookups.get(normalize_mbi(mbi))
+        if pending is not None and not pending.event.is_set():
+            pending.finish(outcome, data)
+
+    def fail(self, mbi, cause):
+        # Called by the worker threads when a lookup was dropped
+        with self.lock:
+            pending = self.lookups.get(normalize_mbi(mbi))
+        if pending is not None and not pending.event.is_set():
+            pending.finish(FAILED, error=cause)
+
+    def stats(self):
+        with self.lock:
+            return {"requested": self.requested, "coalesced": self.coalesced, "in_progress": sum(1 for lookup in self.lookups.values() if lookup.finished_at is None)}
+
+
+class ServiceRequestHandler(BaseHTTPRequestHandler):
+    # JSON API of the service. POST /lookup looks up Medicare Numbers, GET /status describes the service.
+
+    def do_POST(self):
+        if self.path != "/lookup":
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            payload = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            self.send_json(400, {"error": "The request body must be JSON"})
+            return
+        status, response = self.server.handle_lookup(payload)
+        self.send_json(status, response)
+
+    def do_GET(self):
+        if self.path != "/status":
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+            return
+        self.send_json(200, self.server.status())
+
+    def send_json(self, status, response):
+        body = json.dumps(response, default=str).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_server(host, port, handle_lookup, status):
+    # This method starts the HTTP server of the service in a background thread and returns it.
+    # 'handle_lookup' is called with the JSON payload of a lookup request and returns a tuple of
+    # (HTTP status, response), 'status' returns the description of the service.
+    server = ThreadingHTTPServer((host, port), ServiceRequestHandler)
+    server.daemon_threads = True
+    server.handle_lookup = handle_lookup
+    server.status = status
+    threading.Thread(target=server.serve_forever, name="service", daemon=True).start()
+    return server
+
+
+def submit_policies(service_url, policies, write_back, timeout):
+    # This method sends a batch of policies to a running service and returns their results
+    response = requests.post(f"{service_url.rstrip('/')}/lookup", json={"policies": policies, "write_back": write_back, "timeout": timeout}, timeout=timeout + 60)
+    response.raise_for_status()
+    return response.json()["results"]
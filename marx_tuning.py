@@ -0,0 +1,105 @@
+import threading
+import time
+
+
+class WorkerPoolTuner:
+    # Keeps track of which CMS accounts are in use and decides when to add or remove
+    # a session, based on the lookup latency and error rate observed since the last decision.
+    # The slowest acceptable latency is measured against the best window seen so far, as
+    # portal slowdowns show up as longer waits before they turn into timeouts.
+
+    def __init__(self, accounts, max_workers, interval=120, cooldown=300, min_samples=10, max_error_rate=0.2, slowdown_factor=1.5, acquire=None, release=None):
+        # 'acquire' is called with an account before it is claimed and returns whether it can be used,
+        # 'release' is called with it once it is released
+        self.free_accounts = list(accounts)
+        self.acquire = acquire
+        self.release = release
+        self.active_accounts = []
+        self.retiring_accounts = set()
+        self.max_workers = max_workers
+        self.interval = interval
+        self.cooldown = cooldown
+        self.min_samples = min_samples
+        self.max_error_rate = max_error_rate
+        self.slowdown_factor = slowdown_factor
+        self.samples = []
+        self.baseline_latency = None
+        self.last_change = time.monotonic()
+        self.lock = threading.Lock()
+
+    def claim_account(self):
+        # Returns the next free account number that can be acquired, or None if the ceiling or the pool is exhausted
+        with self.lock:
+            if len(self.active_accounts) >= self.max_workers:
+                return None
+            for account in list(self.free_accounts):
+                if self.acquire is None or self.acquire(account):
+                    self.free_accounts.remove(account)
+                    self.active_accounts.append(account)
+                    self.last_change = time.monotonic()
+                    return account
+            return None
+
+    def release_account(self, account):
+        # Called by a thread when it stops, so that its account can be claimed again
+        with self.lock:
+            if account in self.active_accounts:
+                self.active_accounts.remove(account)
+            self.retiring_accounts.discard(account)
+            self.free_accounts.append(account)
+            if self.release is not None:
+                self.release(account)
+
+    def record(self, latency, failed):
+        # Records the duration of a single lookup attempt and whether it failed
+        with self.lock:
+            self.samples.append((latency, failed))
+
+    def should_retire(self, account):
+        with self.lock:
+            return account in self.retiring_accounts
+
+    def active_count(self):
+        with self.lock:
+            return len(self.active_accounts) - len(self.retiring_accounts)
+
+    def evaluate(self):
+        # Evaluates the samples recorded since the last call and returns a tuple of the
+        # decision (+1 to add a session, -1 to remove one, 0 to keep) and the reason for it.
+        # When removing a session, the most recently started account is marked as retiring.
+        with self.lock:
+            samples = self.samples
+            active = len(self.active_accounts) - len(self.retiring_accounts)
+
+            if len(samples) < self.min_samples:
+                return 0, f"Not enough lookups to evaluate ({len(samples)} of {self.min_samples})"
+            self.samples = []
+
+            average_latency = sum(latency for latency, _ in samples) / len(samples)
+            error_rate = sum(1 for _, failed in samples if failed) / len(samples)
+            if self.baseline_latency is None or average_latency < self.baseline_latency:
+                self.baseline_latency = average_latency
+
+            stats = f"{active} sessions, {len(samples)} lookups, average latency {average_latency:.1f}s (best {self.baseline_latency:.1f}s), error rate {error_rate:.0%}"
+
+            if time.monotonic() - self.last_change < self.cooldown:
+                return 0, f"Waiting for the last change to settle. {stats}"
+
+            # Portal is struggling: drop the newest session
+            if error_rate > self.max_error_rate or average_latency > self.baseline_latency * self.slowdown_factor:
+                if active <= 1:
+                    return 0, f"Portal is slowing down but only one session is left. {stats}"
+                for account in reversed(self.active_accounts):
+                    if account not in self.retiring_accounts:
+                        self.retiring_accounts.add(account)
+                        break
+                self.last_change = time.monotonic()
+                return -1, f"Removing session for account {account}. {stats}"
+
+            # Portal is healthy: add a session if there is room for one
+            if error_rate <= self.max_error_rate / 2 and average_latency <= self.baseline_latency * (1 + (self.slowdown_factor - 1) / 2):
+                if not self.free_accounts or len(self.active_accounts) >= self.max_workers:
+                    return 0, f"Portal is healthy, all allowed sessions are in use. {stats}"
+                return 1, f"Portal is healthy, adding a session. {stats}"
+
+            return 0, f"Keeping the current sessions. {stats}"
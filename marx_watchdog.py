@@ -0,0 +1,66 @@
+import threading
+import time
+
+
+class BrowserKilled(Exception):
+    # Raised in a thread whose browser was killed by the watchdog
+    pass
+
+
+class BrowserWatchdog:
+    # Keeps track of how long each thread has been waiting on its browser and kills the browser
+    # of a thread that goes past its deadline. The calls blocked on the hung browser then fail,
+    # and the thread starts a new browser for its account.
+
+    def __init__(self, lookup_deadline=300, check_interval=10, on_kill=None):
+        # 'on_kill' is called with a message every time a browser is killed
+        self.lookup_deadline = lookup_deadline
+        self.check_interval = check_interval
+        self.on_kill = on_kill
+        self.watched = {}
+        self.killed = set()
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.watch, name="watchdog", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+
+    def begin(self, account, driver, deadline=None):
+        # Starts the clock on a browser call of 'account', with the lookup deadline unless another one is given
+        with self.lock:
+            self.watched[account] = (driver, time.monotonic() + (deadline or self.lookup_deadline))
+
+    def end(self, account):
+        with self.lock:
+            self.watched.pop(account, None)
+
+    def was_killed(self, account):
+        with self.lock:
+            return account in self.killed
+
+    def replaced(self, account):
+        # Called once the thread of 'account' has moved on to a new browser
+        with self.lock:
+            self.killed.discard(account)
+
+    def watch(self):
+        while not self.stop_event.wait(self.check_interval):
+            now = time.monotonic()
+            with self.lock:
+                hung = [(account, driver) for account, (driver, deadline) in self.watched.items() if now >= deadline]
+                for account, _ in hung:
+                    del self.watched[account]
+                    self.killed.add(account)
+
+            for account, driver in hung:
+                try:
+                    driver.kill()
+                except Exception as e:
+                    print(f"Watchdog could not kill the browser of account {account}: {type(e).__name__}")
+                if self.on_kill is not None:
+                    self.on_kill(f"Watchdog killed the hung browser of account {account}")